@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import random
+import threading
+import time
+import Queue
+
+
+class AccessLog(object):
+    """
+    Log written from a background thread. Callers only put the message
+    and its arguments into a bounded queue - formatting and I/O happen in
+    the writer thread, in batches of up to `batch_size` records. When the
+    queue is full the record is dropped and counted in `dropped`.
+
+    Request bodies longer than `max_body_size` are logged in full for
+    `body_sample_rate` share of requests, truncated otherwise.
+    """
+
+    def __init__(self,
+                 logger=None,
+                 max_queue=10000,
+                 batch_size=100,
+                 max_body_size=1024,
+                 body_sample_rate=0.01):
+
+        self._logger = logger or logging.getLogger()
+        self._queue = Queue.Queue(max_queue)
+        self._batch_size = batch_size
+        self._max_body_size = max_body_size
+        self._body_sample_rate = body_sample_rate
+
+        self._lock = threading.Lock()
+        self._writer = None
+        self.dropped = 0
+
+    def _start(self):
+        # started on first use - so that forked workers get their own
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name='access-log')
+                self._writer.daemon = True
+                self._writer.start()
+
+    def log(self, msg, *args, **kwargs):
+        level = kwargs.get('level', logging.INFO)
+        if not self._logger.isEnabledFor(level):
+            return
+        if self._writer is None:
+            self._start()
+        try:
+            self._queue.put_nowait((time.time(), level, msg, args))
+        except Queue.Full:
+            self.dropped += 1
+
+    def log_request(self, path, body, request_id):
+        if len(body) > self._max_body_size and random.random() >= self._body_sample_rate:
+            body = "%s... (%s bytes)" % (body[:self._max_body_size], len(body))
+        self.log("%s: %s %s", path, body, request_id)
+
+    def _write(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            for item in batch:
+                if item is None:
+                    return
+                created, level, msg, args = item
+                record = self._logger.makeRecord(self._logger.name, level, __file__, 0, msg, args, None)
+                record.created = created
+                record.msecs = (created - int(created)) * 1000
+                try:
+                    self._logger.handle(record)
+                except Exception:
+                    self.dropped += 1
+
+    def close(self):
+        """Writes out the queued records and stops the writer"""
+        with self._lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._queue.put(None)
+            writer.join()
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'dropped': self.dropped,
+        }
@@ -2,17 +2,33 @@
 # -*- coding: utf-8 -*-
 
 import abc
-import json
 import datetime
+import errno
 import logging
 import hashlib
+import itertools
+import os
+import re
+import select
+import signal
+import socket
+import threading
+import time
 import uuid
+import Queue
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 
+import codec
+import metrics
 import scoring
 import store
+import tracing
+from accesslog import AccessLog
+from batching import BatchLoader
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -21,12 +37,14 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+REQUEST_TOO_LARGE = 413
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    REQUEST_TOO_LARGE: "Request Entity Too Large",
     INVALID_REQUEST: "Invalid Request",
     INTERNAL_ERROR: "Internal Server Error",
 }
@@ -38,6 +56,52 @@ GENDERS = {
     MALE: "male",
     FEMALE: "female",
 }
+AUTH_SECONDS = metrics.registry.histogram("auth_seconds", "Token verification time")
+VALIDATION_SECONDS = metrics.registry.histogram("validation_seconds", 
+                                                "Method request validation time, including auth")
+DATE_FORMAT = '%d.%m.%Y'
+DATE_RE = re.compile(r'(\d{2})\.(\d{2})\.(\d{4})\Z')
+PARSED_DATES_MAX = 4096
+
+
+_parsed_dates = {}
+
+def parse_date(value):
+    """
+    Same as datetime.strptime(value, DATE_FORMAT), but skips strptime 
+    for well-formed dd.mm.yyyy strings and remembers recent results.
+    """
+    try:
+        return _parsed_dates[value]
+    except (KeyError, TypeError):
+        pass
+
+    m = DATE_RE.match(value) if isinstance(value, basestring) else None
+    if m:
+        day, month, year = m.groups()
+        parsed = datetime(int(year), int(month), int(day))
+    else:
+        # anything unusual gets exactly the strptime treatment
+        parsed = datetime.strptime(value, DATE_FORMAT)
+
+    if len(_parsed_dates) >= PARSED_DATES_MAX:
+        _parsed_dates.clear()
+    _parsed_dates[value] = parsed
+    return parsed
+
+
+_now = (0, None) # (timestamp, datetime)
+
+def current_datetime():
+    """datetime.now(), refreshed at most once a second"""
+    global _now
+    timestamp, now = _now
+    t = time.time()
+    if t - timestamp >= 1:
+        now = datetime.now()
+        _now = (t, now)
+    return now
+
 
 class FieldValidationError(Exception):
     
@@ -57,21 +121,57 @@ class AuthError(Exception):
     pass
 
 
+class RequestBodyError(Exception):
+
+    def __init__(self, message, code=BAD_REQUEST):
+        super(RequestBodyError, self).__init__(message)
+        self.code = code
+
+
 class Field(object):
+    """
+    Validating descriptor. Validated values are kept on the instance 
+    the field belongs to (in attribute `attr`), not on the field itself.
+    """
 
     __metaclass__ = abc.ABCMeta 
 
+    _creation_counter = itertools.count()
+
     def __init__(self, required=False, nullable=True):
         self.required = required
         self.nullable = nullable
+        self.creation_order = next(Field._creation_counter)
+
+        self.name = None
+        self.attr = None
+
+    def bind(self, name):
+        self.name = name
+        self.attr = '_' + name
+
+    def _bind_to_owner(self, owner):
+        # fields declared outside of ApiRequest do not get bound by 
+        # the metaclass - look up the name they are declared under
+        for klass in owner.__mro__:
+            for name, value in klass.__dict__.iteritems():
+                if value is self:
+                    self.bind(name)
+                    return
 
-        self.value = None
+        raise AttributeError('field is not declared in %s' % owner.__name__)
 
     def __set__(self, obj, value):
-        self.value = self.validate(value)
+        if self.attr is None:
+            self._bind_to_owner(type(obj))
+        setattr(obj, self.attr, self.validate(value))
 
     def __get__(self, obj, type=None):
-        return self.value
+        if obj is None:
+            return self
+        if self.attr is None:
+            self._bind_to_owner(type or obj.__class__)
+        return getattr(obj, self.attr, None)
 
     def _field_error(self, message):
         message = "%s %s" % (self.__class__.__name__, message)
@@ -139,7 +239,7 @@ class DateField(Field):
 
         if not value==None:
             try:
-                value = datetime.strptime(value, '%d.%m.%Y')
+                value = parse_date(value)
             except ValueError:
                 raise self._field_error('invalid date')
 
@@ -152,7 +252,7 @@ class BirthDayField(DateField):
         value = super(BirthDayField, self).validate(value)
 
         if not value==None:
-            if datetime.now().year - value.year > 70:
+            if current_datetime().year - value.year > 70:
                 raise self._field_error('invalid birth date (age must be <= 70)')
 
         return value
@@ -202,25 +302,59 @@ class ClientIDsField(Field):
                 
         return value
 
+class ApiRequestMeta(abc.ABCMeta):
+    """
+    Compiles every request class once, at class creation:
+
+    * binds declared fields to their names and adds a slot for every 
+      field value, so request instances carry no per-instance __dict__;
+    * builds the validation plan - fields in declaration order 
+      (inherited first), required field names and validators.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        slots = list(attrs.get('__slots__', ()))
+        declared = []
+        for key, value in attrs.iteritems():
+            if isinstance(value, Field):
+                value.bind(key)
+                slots.append(value.attr)
+                declared.append(value)
+
+        attrs['__slots__'] = tuple(slots)
+        cls = super(ApiRequestMeta, mcs).__new__(mcs, name, bases, attrs)
+
+        fields = OrderedDict()
+        for base in reversed(bases):
+            fields.update(getattr(base, 'fields', {}))
+        for field in sorted(declared, key=lambda f: f.creation_order):
+            fields[field.name] = field
+
+        cls.fields = fields
+        cls._required = tuple(k for k, f in fields.iteritems() if f.required)
+        cls._plan = tuple((k, f.attr, f.validate) for k, f in fields.iteritems())
+        return cls
+
+
 class ApiRequest(object):
 
-    __metaclass__ = abc.ABCMeta
+    __metaclass__ = ApiRequestMeta
+    __slots__ = ('request',)
     
     def __init__(self, request_data):
 
         self.request = request_data
-        self.fields = {k:v for k,v in self.__class__.__dict__.iteritems() if issubclass(v.__class__, Field)}
 
         # check keys -  if all required data passed
-        requireds = set(k for k,v in self.fields.iteritems() if v.required)
-        remains =  requireds - set(request_data.keys())
-        if remains:
-            raise ValidationError(message="required", field=requireds.pop())
+        for k in self._required:
+            if k not in request_data:
+                raise ValidationError(message="required", field=k)
 
         # assign and validate fields
-        for k,v in self.fields.iteritems():
+        get = request_data.get
+        for k, attr, validate in self._plan:
             try:
-                self.__setattr__(k, request_data.get(k, None)) # field vailues get validated here
+                setattr(self, attr, validate(get(k)))
             except FieldValidationError as e:
                 raise ValidationError(message=e.message, field=k)
 
@@ -229,7 +363,7 @@ class ApiRequest(object):
 
 
     def __str__(self):
-        return "<ApiRequest %s fields: >" % (self.__class__.__name__, " ".join(["%s:%s"%(k,v) for k,v in self.fields.iteritems()]))
+        return "<%s fields: %s>" % (self.__class__.__name__, " ".join(["%s:%s" % (k, getattr(self, k)) for k in self.fields]))
 
     @abc.abstractmethod
     def validate(self):
@@ -246,10 +380,13 @@ class ClientsInterestsRequest(ApiRequest):
     def validate(self):
         return self
 
-    def process(self, ctx=None, store=None):
-        result = {}
-        for cid in self.client_ids:
-            result[cid] = scoring.get_interests(store, cid)
+    @tracing.traced("ClientsInterestsRequest.process")
+    def process(self, ctx=None, store=None, interests=None):
+        # interests may come prefetched (e.g. for a whole batch)
+        if interests is None:
+            result = scoring.get_interests_many(store, self.client_ids, raw=True)
+        else:
+            result = dict((cid, interests.get(cid, scoring.EMPTY_INTERESTS)) for cid in self.client_ids)
 
         ctx.update({'nclients':len(self.client_ids)})
         return result
@@ -276,8 +413,9 @@ class OnlineScoreRequest(ApiRequest):
                                   '(first_name, last_name) or '
                                   '(birthday, gender) passed')
 
+    @tracing.traced("OnlineScoreRequest.process")
     def process(self, ctx=None, store=None):
-        score = scoring.get_score(None, 
+        score = scoring.get_score(store, 
                                   self.phone, 
                                   self.email, 
                                   self.birthday,
@@ -285,8 +423,10 @@ class OnlineScoreRequest(ApiRequest):
                                   self.first_name, 
                                   self.last_name)
 
-        actual_fields = [f for f in self.fields if not f==None]
-        ctx.update({'has':actual_fields})
+        # passed non-null arguments, in the order of the request
+        actual_fields = [k for k in self.request if k in self.fields and getattr(self, k) is not None]
+        ctx.update({'has':actual_fields, 
+                    'score_cache_hit_rate': scoring.score_cache_stats.hit_rate})
 
         return  {"score": score}
 
@@ -299,14 +439,17 @@ class MethodRequest(ApiRequest):
     arguments = ArgumentsField(required=True, nullable=True)
     method = CharField(required=True, nullable=False)
 
+    __slots__ = ('handler_class', 'auth')
 
     __method_handlers__ = {
         'online_score': OnlineScoreRequest,
         'client_instrests': ClientsInterestsRequest,
     }
 
-    def __init__(self, fields):
+    @tracing.traced("MethodRequest.__init__", VALIDATION_SECONDS)
+    def __init__(self, fields, auth=None):
         self.handler_class = None
+        self.auth = auth or check_auth
         super(MethodRequest, self).__init__(fields)
         
     @property
@@ -314,12 +457,12 @@ class MethodRequest(ApiRequest):
         return self.login == ADMIN_LOGIN
 
     def __str__(self):
-        return "<request %s(%s) auth=%s:%s>" % (self.method, json.dumps(self.arguments), self.login, self.token)
+        return "<request %s(%s) auth=%s:%s>" % (self.method, codec.dumps(self.arguments), self.login, self.token)
 
     def validate(self):
 
         # check auth 
-        logged_id = check_auth(self)
+        logged_id = self.auth(self)
         if not logged_id:
             raise AuthError()
 
@@ -331,88 +474,704 @@ class MethodRequest(ApiRequest):
 
         return self
 
+    def handler(self):
+        return self.handler_class(self.arguments)
+
     def process(self, ctx, store):
-        return self.handler_class(self.arguments).process(ctx, store)
+        return self.handler().process(ctx, store)
+
+
+class AuthCache(object):
+    """
+    Remembers verified (account, login, token) triples - up to `max_size`,
+    least recently used are dropped first. Admin digest depends on the 
+    current hour only, it is computed once an hour.
+    """
+
+    def __init__(self, max_size=10000):
+        # user digests never change - entries do not expire
+        self._verified = store.LRUCache(max_size, default_ttl=float('inf'))
+        self._admin = (0, None) # (valid until, digest)
+
+    def admin_digest(self):
+        expires, digest = self._admin
+        now = time.time()
+        if now >= expires:
+            hour = datetime.now().replace(minute=0, second=0, microsecond=0)
+            digest = hashlib.sha512(hour.strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+            expires = time.mktime((hour + timedelta(hours=1)).timetuple())
+            self._admin = (expires, digest)
+        return digest
+
+    def check(self, account, login, token):
+        if login == ADMIN_LOGIN:
+            return self.admin_digest() == token
+
+        key = (account, login, token)
+        if self._verified.get(key):
+            return True
+
+        digest = hashlib.sha512(account + login + SALT).hexdigest()
+        if digest == token:
+            self._verified.set(key, True)
+            return True
+        return False
+
+    def stats(self):
+        return self._verified.stats()
+
+
+class ResponseCache(object):
+    """
+    Serialized client_instrests responses, keyed on the method and its
+    canonical arguments (sorted distinct client ids, date). Holds up to 
+    `max_size` responses of `max_bytes` total, least recently used are 
+    dropped first, every response lives at most `ttl` seconds.
+
+    A response is dropped as soon as a store of this process writes the 
+    interests of any of its clients. Writes made by other processes are 
+    seen after `ttl`.
+    """
+
+    def __init__(self, max_size=1000, max_bytes=64 * 1024 * 1024, ttl=60):
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._data = OrderedDict() # key -> (expires, client ids, response)
+        self._by_client = {}       # client id -> set of keys
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # bumped by every invalidation - responses computed across
+        # a write are not stored
+        self.generation = 0
+
+        self._hits = metrics.registry.counter('response_cache_hits')
+        self._misses = metrics.registry.counter('response_cache_misses')
+
+    @staticmethod
+    def key(method, client_ids, date):
+        canonical = "%s|%s|%s" % (method, ",".join(str(cid) for cid in sorted(set(client_ids))), 
+                                  "%04d%02d%02d" % (date.year, date.month, date.day) if date else "")
+        return hashlib.md5(canonical).digest()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self._misses.inc()
+                return None
+
+            # re-insert as the most recently used
+            del self._data[key]
+            self._data[key] = entry
+            self._hits.inc()
+            return entry[2]
+
+    def set(self, key, client_ids, response, generation):
+        size = len(response.encoded_json)
+        if size > self._max_bytes:
+            return
+
+        client_ids = frozenset(client_ids)
+        with self._lock:
+            if generation != self.generation:
+                return
+
+            self._remove(key)
+            self._data[key] = (time.time() + self._ttl, client_ids, response)
+            self._bytes += size
+            for cid in client_ids:
+                self._by_client.setdefault(cid, set()).add(key)
+
+            while len(self._data) > self._max_size or self._bytes > self._max_bytes:
+                self._remove(next(iter(self._data)))
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+
+        _, client_ids, response = entry
+        self._bytes -= len(response.encoded_json)
+        for cid in client_ids:
+            keys = self._by_client.get(cid)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_client[cid]
+
+    def invalidate(self, store_keys):
+        """Drops responses that include interests under `store_keys` ("i:<cid>")"""
+        with self._lock:
+            self.generation += 1
+            for store_key in store_keys:
+                if not store_key.startswith("i:"):
+                    continue
+                try:
+                    cid = int(store_key[2:])
+                except ValueError:
+                    continue
+                for key in list(self._by_client.get(cid, ())):
+                    self._remove(key)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'bytes': self._bytes,
+                'max_size': self._max_size,
+                'max_bytes': self._max_bytes,
+            }
+
+
+auth_cache = AuthCache()
+access_log = AccessLog()
+profiler = tracing.Profiler()
+response_cache = None # ResponseCache, if enabled
+
+
+def invalidate_responses(keys):
+    if response_cache is not None:
+        response_cache.invalidate(keys)
+
+store.add_write_listener(invalidate_responses)
 
 
+metrics.registry.gauge("auth_cache_hits", lambda: auth_cache.stats()["hits"])
+metrics.registry.gauge("auth_cache_misses", lambda: auth_cache.stats()["misses"])
+
+
+@tracing.traced("check_auth", AUTH_SECONDS)
 def check_auth(request):
-    if request.login == ADMIN_LOGIN:
-        digest = hashlib.sha512(datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+    return auth_cache.check(request.account, request.login, request.token)
+
+
+def error_response(e):
+    if isinstance(e, AuthError):
+        return 'Forbidden', FORBIDDEN
+
+    if e.field:
+        response = 'field "%s" error: %s' % (e.field, e.message)
     else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+        response = e.message
+
+    return response, INVALID_REQUEST
+
+
+def make_envelope(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    else:
+        return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+def cached_process(method_request, ctx, store):
+    """Processes client_instrests requests through response_cache"""
+    handler = method_request.handler()
+    key = response_cache.key(method_request.method, handler.client_ids, handler.date)
+    response = response_cache.get(key)
+    if response is not None:
+        ctx.update({'nclients': len(handler.client_ids), 'response_cached': True})
+        return response
+
+    generation = response_cache.generation
+    response = codec.RawJSON(codec.dumps(handler.process(ctx, store)))
+    response_cache.set(key, handler.client_ids, response, generation)
+    return response
 
 
 def method_handler(request, ctx, store):
     try:
         api_request = MethodRequest(request['body'])
-        response = api_request.process(ctx, store)
-        code = 200
-    except ValidationError as e:
-        if e.field:
-            response = 'field "%s" error: %s' % (e.field, e.message)
+        if response_cache is not None and api_request.handler_class is ClientsInterestsRequest:
+            response = cached_process(api_request, ctx, store)
         else:
-            response = e.message
-
-        code = INVALID_REQUEST
-
-    except AuthError:
-        code = FORBIDDEN
-        response = 'Forbidden'
+            response = api_request.process(ctx, store)
+        code = 200
+    except (ValidationError, AuthError) as e:
+        response, code = error_response(e)
 
     #todo: update ctx - has
     return response, code
 
 
+def batch_handler(request, ctx, store):
+    """
+    Handles a list of method requests. Every distinct account/login/token
+    is checked once, interests of all client_instrests items are fetched 
+    in one store lookup. Responds with a list of per-item envelopes.
+    """
+    items = request['body']
+    if not isinstance(items, list):
+        return 'batch must be a list of method requests', INVALID_REQUEST
+
+    verified = {}
+    def auth(method_request):
+        key = (method_request.account, method_request.login, method_request.token)
+        if key not in verified:
+            verified[key] = check_auth(method_request)
+        return verified[key]
+
+    # validate all items first, so that store lookups can be merged
+    results = [None] * len(items)
+    handlers = []
+    for i, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValidationError('batch item must be an object')
+            handlers.append((i, MethodRequest(item, auth=auth).handler()))
+        except (ValidationError, AuthError) as e:
+            results[i] = make_envelope(*error_response(e))
+        except Exception as e:
+            # one broken item must not fail the whole batch
+            logging.exception("Unexpected error: %s" % e)
+            results[i] = make_envelope(None, INTERNAL_ERROR)
+
+    client_ids = set()
+    for _, handler in handlers:
+        if isinstance(handler, ClientsInterestsRequest):
+            client_ids.update(handler.client_ids)
+    interests = scoring.get_interests_many(store, client_ids, raw=True) if client_ids else {}
+
+    items_ctx = []
+    for i, handler in handlers:
+        item_ctx = {}
+        try:
+            if isinstance(handler, ClientsInterestsRequest):
+                response = handler.process(item_ctx, store, interests=interests)
+            else:
+                response = handler.process(item_ctx, store)
+            results[i] = make_envelope(response, OK)
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+            results[i] = make_envelope(None, INTERNAL_ERROR)
+        items_ctx.append(item_ctx)
+
+    ctx.update({'nitems': len(items), 'items': items_ctx})
+    return results, OK
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
-        "method": method_handler
+        "method": method_handler,
+        "batch": batch_handler,
     }
+    max_body_size = 1024 * 1024 # bytes
+    max_line_size = 64 * 1024
+
+    # HTTP/1.1 persistent connections, where the server allows them 
+    # (server.keepalive): idle connections are closed after `timeout` 
+    # seconds, as soon as other connections wait for a worker, or after 
+    # `max_keepalive_requests` requests
+    protocol_version = "HTTP/1.1"
+    timeout = 5 # seconds
+    keepalive_poll = 0.05 # seconds
+    max_keepalive_requests = 100
+    # headers and body go out in one packet
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.requests_served = 0
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection and self.wait_next_request():
+            self.handle_one_request()
+
+    def wait_next_request(self):
+        """
+        Waits for the next request on a persistent connection. False if 
+        the connection was idle for `timeout` seconds or other connections 
+        are waiting - an idle client must not hold the worker.
+        """
+        if not getattr(self.server, 'keepalive', False):
+            return False
+
+        # a pipelined request may already be read into the buffer
+        buffered = getattr(self.rfile, '_rbuf', None)
+        if buffered is not None and buffered.tell():
+            return True
+
+        deadline = time.time() + self.timeout
+        while True:
+            wait = min(self.keepalive_poll, deadline - time.time())
+            if wait <= 0:
+                return False
+            try:
+                readable, _, _ = select.select([self.connection], [], [], wait)
+            except select.error:
+                # interrupted by a signal, e.g. the one stopping the worker
+                readable = []
+            if readable:
+                return True
+            if self.server.connections_waiting():
+                return False
 
     def get_request_id(self, headers):
         return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
 
+    def read_body(self):
+        """
+        Reads request body - Content-Length or chunked, bodies over 
+        max_body_size are rejected before being read
+        """
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            return self._read_chunked_body()
+
+        try:
+            length = int(self.headers['Content-Length'])
+        except (KeyError, TypeError, ValueError):
+            raise RequestBodyError('invalid or missing Content-Length')
+
+        if length < 0:
+            raise RequestBodyError('invalid Content-Length')
+        if length > self.max_body_size:
+            raise RequestBodyError('request body too large', REQUEST_TOO_LARGE)
+
+        body = self.rfile.read(length)
+        if len(body) < length:
+            raise RequestBodyError('incomplete request body')
+        return body
+
+    def _read_chunked_body(self):
+        chunks = []
+        size = 0
+        while True:
+            line = self.rfile.readline(self.max_line_size)
+            try:
+                chunk_size = int(line.split(';', 1)[0].strip(), 16)
+            except ValueError:
+                raise RequestBodyError('invalid chunk size')
+
+            # read(-1) would read the connection to the end
+            if chunk_size < 0:
+                raise RequestBodyError('invalid chunk size')
+            if chunk_size == 0:
+                break
+
+            size += chunk_size
+            if size > self.max_body_size:
+                raise RequestBodyError('request body too large', REQUEST_TOO_LARGE)
+
+            chunk = self.rfile.read(chunk_size)
+            if len(chunk) < chunk_size:
+                raise RequestBodyError('incomplete request body')
+            chunks.append(chunk)
+            self.rfile.readline(self.max_line_size) # CRLF after chunk data
+
+        # skip trailer headers
+        while self.rfile.readline(self.max_line_size) not in ('\r\n', '\n', ''):
+            pass
+
+        return ''.join(chunks)
+
     def do_POST(self):
+        started = time.time()
         response, code = {}, OK
         context = {"request_id": self.get_request_id(self.headers)}
         request = None
         try:
-            data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
+            data_string = self.read_body()
+            request = codec.loads(data_string)
+        except RequestBodyError as e:
+            logging.error('request read error: %s', e.message)
+            code = e.code
+            # the rest of the body is left unread
+            self.close_connection = 1
         except Exception as e:
             logging.error('request read error: %s', e.message)
             code = BAD_REQUEST
 
+        path = self.path.strip("/")
         if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
+            access_log.log_request(self.path, data_string, context["request_id"])
             if path in self.router:
-                try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context, store)
-                except Exception, e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
+                with tracing.request_scope(context["request_id"]) as trace, profiler.sample():
+                    try:
+                        response, code = self.router[path]({"body": request, "headers": self.headers}, context, store)
+                    except Exception, e:
+                        logging.exception("Unexpected error: %s" % e)
+                        code = INTERNAL_ERROR
+                context["spans"] = trace.as_list()
             else:
                 code = NOT_FOUND
 
+        r = make_envelope(response, code)
+        context.update(r)
+        access_log.log("%s", context)
+        self.send_body(code, codec.dumps(r))
+
+        # labels come from the request - keep them to the known values
+        method = request.get("method") if isinstance(request, dict) else None
+        if not isinstance(method, basestring) or method not in MethodRequest.__method_handlers__:
+            method = "none"
+        labels = {"path": path if path in self.router else "unknown", "method": method}
+        metrics.registry.counter("http_requests_total", "Requests by path, method and code", 
+                                 code=code, **labels).inc()
+        metrics.registry.histogram("http_request_seconds", "Request handling time", 
+                                   **labels).observe(time.time() - started)
+        return
+
+    def do_GET(self):
+        if self.path.strip("/") == "metrics":
+            self.send_body(OK, metrics.registry.render(), "text/plain; version=0.0.4")
+        else:
+            self.send_body(NOT_FOUND, codec.dumps(make_envelope(None, NOT_FOUND)))
+
+    def send_body(self, code, body, content_type="application/json"):
+        self.requests_served += 1
+        if self.requests_served >= self.max_keepalive_requests or \
+           not getattr(self.server, 'keepalive', False):
+            self.close_connection = 1
+
         self.send_response(code)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version == "HTTP/1.0":
+            self.send_header("Connection", "keep-alive")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
+        self.wfile.write(body)
+
+class KeepAliveMixIn:
+    """
+    Server keeping connections open between requests. A plain HTTPServer
+    serves one connection at a time - it closes every connection after 
+    the response instead.
+    """
+
+    keepalive = True
+    # set when the server is shutting down - idle connections are let go
+    stopping = False
+
+    def connections_waiting(self):
+        """True while connections wait to be accepted or the server stops"""
+        if self.stopping:
+            return True
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            # closed - let idle connections go
+            return True
+        return bool(readable)
+
+
+class KeepAliveHTTPServer(KeepAliveMixIn, HTTPServer):
+    """HTTPServer with keep-alive, for prefork workers sharing the socket"""
+
+
+class ThreadPoolHTTPServer(KeepAliveMixIn, ThreadingMixIn, HTTPServer):
+    """HTTPServer handing accepted connections to a fixed pool of threads"""
+
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, workers=4):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self._requests = Queue.Queue(maxsize=workers * 2)
+        self._workers = []
+        for i in xrange(workers):
+            t = threading.Thread(target=self._worker, name='http-worker-%s' % i)
+            t.daemon = self.daemon_threads
+            t.start()
+            self._workers.append(t)
+
+    def _worker(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            self.process_request_thread(*item)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def connections_waiting(self):
+        return not self._requests.empty() or KeepAliveMixIn.connections_waiting(self)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        # connections nobody has picked up yet are closed, so that the
+        # queue has room for a stop marker for every worker
+        while True:
+            try:
+                item = self._requests.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None:
+                self.shutdown_request(item[0])
+        for _ in self._workers:
+            self._requests.put(None)
+
+
+def _stop_worker(server):
+    """
+    Signal handler stopping serve_forever of `server` after the current 
+    request. Raising KeyboardInterrupt instead would not do: SocketServer 
+    passes exceptions raised while handling a request to handle_error.
+    """
+    def stop(signum, frame):
+        server.stopping = True
+        # shutdown() waits for serve_forever to return, it can't be 
+        # called from the thread running it
+        thread = threading.Thread(target=server.shutdown, name='shutdown')
+        thread.daemon = True
+        thread.start()
+    return stop
+
+
+def serve_prefork(server, workers, init_worker=None, finish_worker=None):
+    """
+    Fork `workers` processes, all accepting on the listening socket of
+    `server`. Blocks in the parent until the children exit; SIGTERM and 
+    SIGINT of the parent are passed on to the children. Every child
+    calls `init_worker(n)` with its number, 0..workers-1 - the same on
+    every start, unlike the pid.
+    """
+    children = []
+    for worker in xrange(workers):
+        pid = os.fork()
+        if pid == 0:
+            # child: per-process resources (e.g. store connections)
+            # must be created after fork
+            # SIGTERM (and Ctrl+C, sent to the whole process group) stops 
+            # serving, so that finish_worker still runs
+            stop = _stop_worker(server)
+            signal.signal(signal.SIGTERM, stop)
+            signal.signal(signal.SIGINT, stop)
+            if init_worker:
+                init_worker(worker)
+            server.serve_forever()
+            if finish_worker:
+                finish_worker()
+            os._exit(0)
+
+        children.append(pid)
+
+    logging.info("Forked workers: %s", children)
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    handlers = [(signum, signal.signal(signum, stop)) for signum in (signal.SIGTERM, signal.SIGINT)]
+    try:
+        for pid in children:
+            while True:
+                try:
+                    os.waitpid(pid, 0)
+                    break
+                except OSError as e:
+                    # interrupted by a signal - keep waiting for the child
+                    if e.errno != errno.EINTR:
+                        break
+    finally:
+        for signum, handler in handlers:
+            signal.signal(signum, handler)
+
+
+def open_fallback_store(opts, worker=None):
+    if opts.fallback_store == 'memory':
+        return store.MemoryStore()
+
+    if opts.fallback_store == 'disk':
+        # dbm files must not be shared between processes
+        path = opts.fallback_store_path
+        if worker is not None:
+            path = "%s.%s" % (path, worker)
+        return store.DiskStore(path)
+
+    return None
+
+
+def open_store(opts, pool_size=0, worker=None):
+    params = dict(
+        host=opts.tarantool_host, 
+        port=opts.tarantool_port, 
+        user=opts.tarantool_login, 
+        password=opts.tarantool_password
+        )
+    try:
+        if pool_size:
+            db = store.StoreTarantoolPool(max_size=pool_size, **params)
         else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
-        return
+            db = store.StoreTarantool(**params)
+
+        if opts.write_behind_queue:
+            db = store.WriteBehindStore(db, max_queue=opts.write_behind_queue,
+                                        batch_size=opts.write_behind_batch)
+
+        if opts.batch_window:
+            db = BatchLoader(db, window=opts.batch_window / 1000.0,
+                             max_keys=opts.batch_max_keys)
+
+        if opts.l1_cache_size:
+            db = store.L1CacheStore(db, max_size=opts.l1_cache_size, 
+                                    max_ttl=opts.l1_cache_ttl)
+
+        logging.info('Storage %s:%s init sucess',  
+            opts.tarantool_host, opts.tarantool_port)
+
+    except Exception as e:
+        logging.info('Storage %s:%s init failed, starting with %s store. ' 
+            'Error: %s', 
+            opts.tarantool_host, opts.tarantool_port, opts.fallback_store, e.message)
+        db = open_fallback_store(opts, worker)
+
+    return db
+
+
+SERVER_MODES = ('single', 'threaded', 'prefork')
+FALLBACK_STORES = ('memory', 'disk', 'none')
+
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-w", "--workers", action="store", type=int, default=4)
+    op.add_option("-m", "--mode", action="store", type="choice", 
+                  choices=SERVER_MODES, default='single')
+    op.add_option("--max_body_size", action="store", type=int, default=1024 * 1024)
+    op.add_option("--keepalive_timeout", action="store", type=int, default=5)
+    op.add_option("--max_keepalive_requests", action="store", type=int, default=100)
+    op.add_option("--log_queue_size", action="store", type=int, default=10000)
+    op.add_option("--log_body_size", action="store", type=int, default=1024)
+    op.add_option("--log_body_sample", action="store", type=float, default=0.01)
+    op.add_option("--profile_rate", action="store", type=float, default=0,
+                  help="share of requests to profile, 0 - no profiling")
+    op.add_option("--profile_dump", action="store", default="api.prof")
+    op.add_option("--profile_interval", action="store", type=int, default=60)
+    op.add_option("--auth_cache_size", action="store", type=int, default=10000)
+    op.add_option("--batch_window", action="store", type=float, default=0,
+                  help="milliseconds to collect store lookups of concurrent requests, 0 - no batching")
+    op.add_option("--batch_max_keys", action="store", type=int, default=100)
+    op.add_option("--write_behind_queue", action="store", type=int, default=0,
+                  help="cache writes queued for background flushing, 0 - write synchronously")
+    op.add_option("--write_behind_batch", action="store", type=int, default=100)
+    op.add_option("--l1_cache_size", action="store", type=int, default=0)
+    op.add_option("--l1_cache_ttl", action="store", type=int, default=60)
+    op.add_option("--response_cache_size", action="store", type=int, default=0,
+                  help="client_instrests responses to cache, 0 - no response cache")
+    op.add_option("--response_cache_mb", action="store", type=int, default=64)
+    op.add_option("--response_cache_ttl", action="store", type=int, default=60)
+    op.add_option("--fallback_store", action="store", type="choice", 
+                  choices=FALLBACK_STORES, default='memory',
+                  help="store to use when Tarantool is not available")
+    op.add_option("--fallback_store_path", action="store", default='api.store')
     op.add_option("--tarantool_host", action="store", default='localhost')
     op.add_option("--tarantool_port", action="store", default=3301)
     op.add_option("--tarantool_login", action="store", default='score_user')
@@ -421,27 +1180,58 @@ if __name__ == "__main__":
     logging.basicConfig(filename=opts.log, level=logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
 
-    try:
-        store = store.StoreTarantool(
-            host=opts.tarantool_host, 
-            port=opts.tarantool_port, 
-            user=opts.tarantool_login, 
-            password=opts.tarantool_password
-            )
-
-        logging.info('Storage %s:%s init sucess',  
-            opts.tarantool_host, opts.tarantool_port)
-
-    except Exception as e:
-        logging.info('Storage %s:%s init failed, starting with no store. ' 
-            'Error: %s', 
-            opts.tarantool_host, opts.tarantool_port, e.message)
-        store = None
-
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    auth_cache = AuthCache(opts.auth_cache_size)
+    if opts.response_cache_size:
+        response_cache = ResponseCache(opts.response_cache_size, 
+                                       opts.response_cache_mb * 1024 * 1024,
+                                       opts.response_cache_ttl)
+    access_log = AccessLog(max_queue=opts.log_queue_size, 
+                           max_body_size=opts.log_body_size, 
+                           body_sample_rate=opts.log_body_sample)
+    profiler = tracing.Profiler(opts.profile_rate, opts.profile_dump, opts.profile_interval)
+    MainHTTPHandler.max_body_size = opts.max_body_size
+    MainHTTPHandler.timeout = opts.keepalive_timeout
+    MainHTTPHandler.max_keepalive_requests = opts.max_keepalive_requests
+
+    if opts.mode == 'threaded':
+        server = ThreadPoolHTTPServer(("localhost", opts.port), MainHTTPHandler, 
+                                      workers=opts.workers)
+    elif opts.mode == 'prefork':
+        server = KeepAliveHTTPServer(("localhost", opts.port), MainHTTPHandler)
+    else:
+        # one connection at a time - no keep-alive
+        server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+
+    logging.info("Starting server at %s, mode: %s, json: %s", opts.port, opts.mode, codec.BACKEND)
+
+    if opts.mode == 'prefork':
+        def init_worker(worker):
+            global store, profiler
+            store = open_store(opts, worker=worker)
+            # every worker dumps its own profile
+            profiler = tracing.Profiler(opts.profile_rate, 
+                                        "%s.%s" % (opts.profile_dump, worker), 
+                                        opts.profile_interval)
+
+        def finish_worker():
+            if store is not None:
+                store.close()
+            access_log.close()
+            profiler.dump()
+
+        serve_prefork(server, opts.workers, init_worker, finish_worker)
+        server.server_close()
+    else:
+        # worker threads share one store - give each a connection
+        pool_size = opts.workers if opts.mode == 'threaded' else 0
+        store = open_store(opts, pool_size)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+        server.server_close()
+        if store is not None:
+            store.close()
+        access_log.close()
+        profiler.dump()
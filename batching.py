@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cross-request batching of store lookups.
+
+Lookups from concurrent requests are collected for up to `window` seconds
+(or until `max_keys` distinct keys are waiting) and fetched with a single
+get_many/cache_get_many call. A key requested again while its fetch is in
+flight waits for that fetch instead of starting a new one.
+"""
+
+import threading
+
+import metrics
+from store import BaseStore
+
+
+class _Pending(object):
+
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Batcher(object):
+    """
+    Collects keys for `fetch_many(keys) -> {key: value}`. The first caller
+    of a batch waits for the window to pass and fetches the keys of
+    everyone who joined in the meantime.
+    """
+
+    def __init__(self, fetch_many, window=0.002, max_keys=100, name='store'):
+        self._fetch_many = fetch_many
+        self._window = window
+        self._max_keys = max_keys
+
+        self._lock = threading.Lock()
+        self._queued = {}   # key -> _Pending, waiting for the next batch
+        self._inflight = {} # key -> _Pending, being fetched
+        self._collecting = False
+        self._full = threading.Event()
+
+        self._requested = metrics.registry.counter('batch_keys_requested', loader=name)
+        self._fetched = metrics.registry.counter('batch_keys_fetched', loader=name)
+        self._batches = metrics.registry.counter('batch_fetches', loader=name)
+
+    def load(self, keys):
+        if not keys:
+            return {}
+
+        waits = []
+        with self._lock:
+            for key in keys:
+                pending = self._inflight.get(key) or self._queued.get(key)
+                if pending is None:
+                    pending = self._queued[key] = _Pending()
+                waits.append((key, pending))
+
+            leader = not self._collecting
+            if leader:
+                self._collecting = True
+            if len(self._queued) >= self._max_keys:
+                self._full.set()
+
+        self._requested.inc(len(waits))
+        if leader:
+            self._full.wait(self._window)
+            self._dispatch()
+
+        result = {}
+        for key, pending in waits:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            if pending.value is not None:
+                result[key] = pending.value
+        return result
+
+    def _dispatch(self):
+        with self._lock:
+            batch, self._queued = self._queued, {}
+            self._inflight.update(batch)
+            self._collecting = False
+            self._full.clear()
+
+        values, error = {}, None
+        try:
+            values = self._fetch_many(batch.keys())
+        except Exception as e:
+            error = e
+
+        self._batches.inc()
+        self._fetched.inc(len(batch))
+
+        with self._lock:
+            for key, pending in batch.iteritems():
+                if self._inflight.get(key) is pending:
+                    del self._inflight[key]
+
+        for key, pending in batch.iteritems():
+            pending.value = values.get(key)
+            pending.error = error
+            pending.done.set()
+
+
+class BatchLoader(BaseStore):
+    """
+    Wraps a store, batching get/get_many and cache_get/cache_get_many
+    across threads. Writes go straight to the wrapped store.
+    """
+
+    def __init__(self, store, window=0.002, max_keys=100):
+        self.store = store
+        self._data = Batcher(store.get_many, window, max_keys, name='data')
+        self._cache = Batcher(store.cache_get_entries, window, max_keys, name='cache')
+
+    def get(self, key):
+        return self._data.load([key]).get(key)
+
+    def get_many(self, keys):
+        return self._data.load(keys)
+
+    def set(self, key, value):
+        return self.store.set(key, value)
+
+    def set_many(self, items):
+        return self.store.set_many(items)
+
+    def compare_and_set_many(self, items):
+        return self.store.compare_and_set_many(items)
+
+    def iter_data(self, batch_size=1000):
+        return self.store.iter_data(batch_size)
+
+    def get_vocabulary(self):
+        return self.store.get_vocabulary()
+
+    def add_vocabulary(self, names):
+        return self.store.add_vocabulary(names)
+
+    def cache_get(self, key):
+        entry = self._cache.load([key]).get(key)
+        return None if entry is None else entry[0]
+
+    def cache_get_many(self, keys):
+        return dict((key, value) for key, (value, _) in self._cache.load(keys).iteritems())
+
+    def cache_get_entry(self, key):
+        return self._cache.load([key]).get(key)
+
+    def cache_get_entries(self, keys):
+        return self._cache.load(keys)
+
+    def cache_set(self, key, value, ttl=0):
+        return self.store.cache_set(key, value, ttl)
+
+    def close(self):
+        self.store.close()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks.
+
+    python bench.py dates    - date field parsing, fast path vs strptime
+    python bench.py handler  - load test of method_handler, in-process
+    python bench.py http     - load test of the HTTP server over localhost
+
+Load tests send a mix of online_score and client_instrests requests
+(--score_share, --client_ids) from --concurrency threads, against an
+in-memory store or, with --tarantool, a local Tarantool. Results
+(throughput, p50/p95/p99 latency) can be saved with --save and checked
+against a saved baseline with --baseline: the run fails if throughput
+drops or p95 grows by more than --tolerance.
+"""
+
+import httplib
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import timeit
+from datetime import datetime
+from optparse import OptionParser
+
+import api
+import store
+
+ACCOUNT = "111"
+LOGIN = "test"
+TOKEN = "6909573a28d6b12900257df0064967141fb2cd5e82b6c269f3aaf49a0b450749e75872e4a717b90687e7f65bac6c59c0865ecafc467da803a634d5d0079ee9f5"
+
+
+def report(name, seconds, number):
+    print "%-40s %8.3f us/op" % (name, seconds * 1e6 / number)
+
+
+def bench_dates(opts):
+    random.seed(0)
+    year = datetime.now().year
+    dates = ["%02d.%02d.%04d" % (random.randint(1, 28), random.randint(1, 12), random.randint(year - 60, year))
+             for _ in xrange(opts.distinct)]
+    values = [random.choice(dates) for _ in xrange(opts.number)]
+
+    def strptime_path():
+        for v in values:
+            d = datetime.strptime(v, api.DATE_FORMAT)
+            datetime.now().year - d.year > 70
+
+    def cold_path():
+        for v in values:
+            api._parsed_dates.clear()
+            d = api.parse_date(v)
+            api.current_datetime().year - d.year > 70
+
+    def fast_path():
+        for v in values:
+            d = api.parse_date(v)
+            api.current_datetime().year - d.year > 70
+
+    for name, func in [("strptime + now (old)", strptime_path),
+                       ("parse_date + cached now, no memo", cold_path),
+                       ("parse_date + cached now", fast_path)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=opts.repeat))
+        report(name, seconds, opts.number)
+
+
+def make_store(opts):
+    if opts.tarantool:
+        db = store.StoreTarantoolPool(max_size=opts.concurrency, 
+                                      host=opts.tarantool_host, port=opts.tarantool_port)
+    else:
+        db = store.MemoryStore()
+
+    interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+    for cid in xrange(opts.clients):
+        db.set("i:%s" % cid, json.dumps(random.sample(interests, 2)))
+    return db
+
+
+def make_requests(opts):
+    requests = []
+    for _ in xrange(opts.number):
+        if random.random() < opts.score_share:
+            arguments = {
+                "phone": "7%010d" % random.randint(0, opts.clients),
+                "email": "user%s@test.test" % random.randint(0, opts.clients),
+                "birthday": "01.01.1990",
+                "gender": random.choice([0, 1, 2]),
+            }
+            method = "online_score"
+        else:
+            arguments = {
+                "client_ids": random.sample(xrange(opts.clients), min(opts.client_ids, opts.clients)),
+                "date": "01.01.2017",
+            }
+            method = "client_instrests"
+        requests.append({"account": ACCOUNT, "login": LOGIN, "token": TOKEN, 
+                         "method": method, "arguments": arguments})
+    return requests
+
+
+def run_load(send, requests, concurrency):
+    """
+    Sends `requests` with `send(request) -> code` from `concurrency` 
+    threads, returns (latencies, errors, elapsed seconds)
+    """
+    latencies = []
+    errors = []
+    pending = iter(requests)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                request = next(pending, None)
+            if request is None:
+                return
+            started = time.time()
+            code = send(request)
+            latency = time.time() - started
+            with lock:
+                latencies.append(latency)
+                if code != api.OK:
+                    errors.append(code)
+
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in xrange(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return latencies, errors, time.time() - started
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def summarize(name, opts, latencies, errors, elapsed):
+    result = {
+        "benchmark": name,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "concurrency": opts.concurrency,
+        "client_ids": opts.client_ids,
+        "score_share": opts.score_share,
+        "store": "tarantool" if opts.tarantool else "memory",
+        "throughput": len(latencies) / elapsed,
+    }
+    for p in (50, 95, 99):
+        result["p%s" % p] = percentile(latencies, p)
+
+    print "%-10s %8.1f req/s  p50 %7.2f ms  p95 %7.2f ms  p99 %7.2f ms  errors %s" % (
+        name, result["throughput"], result["p50"] * 1000, result["p95"] * 1000, 
+        result["p99"] * 1000, result["errors"])
+    return result
+
+
+def check_baseline(result, opts):
+    """Returns False if result regressed against the saved baseline"""
+    with open(opts.baseline) as f:
+        baseline = json.load(f)
+
+    ok = True
+    if result["throughput"] < baseline["throughput"] * (1 - opts.tolerance):
+        print "REGRESSION: throughput %.1f req/s, baseline %.1f req/s" % (result["throughput"], baseline["throughput"])
+        ok = False
+    if result["p95"] > baseline["p95"] * (1 + opts.tolerance):
+        print "REGRESSION: p95 %.2f ms, baseline %.2f ms" % (result["p95"] * 1000, baseline["p95"] * 1000)
+        ok = False
+    return ok
+
+
+def bench_handler(opts):
+    db = make_store(opts)
+    requests = make_requests(opts)
+
+    def send(request):
+        _, code = api.method_handler({"body": request, "headers": {}}, {}, db)
+        return code
+
+    return summarize("handler", opts, *run_load(send, requests, opts.concurrency))
+
+
+def bench_http(opts):
+    api.store = make_store(opts)
+    api.MainHTTPHandler.log_message = lambda *args: None
+    server = api.ThreadPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, workers=opts.concurrency)
+    port = server.server_address[1]
+    serving = threading.Thread(target=server.serve_forever)
+    serving.daemon = True
+    serving.start()
+
+    requests = [json.dumps(r) for r in make_requests(opts)]
+    connections = threading.local()
+
+    def send(request):
+        # keep-alive connection per client thread
+        conn = getattr(connections, "conn", None)
+        if conn is None:
+            conn = connections.conn = httplib.HTTPConnection("localhost", port)
+        conn.request("POST", "/method", request)
+        response = conn.getresponse()
+        response.read()
+        if response.getheader("Connection") == "close":
+            conn.close()
+            connections.conn = None
+        return response.status
+
+    try:
+        return summarize("http", opts, *run_load(send, requests, opts.concurrency))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+BENCHMARKS = {
+    "dates": bench_dates,
+    "handler": bench_handler,
+    "http": bench_http,
+}
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] " + "|".join(sorted(BENCHMARKS)))
+    op.add_option("-n", "--number", action="store", type=int, default=100000)
+    op.add_option("-r", "--repeat", action="store", type=int, default=3)
+    op.add_option("--distinct", action="store", type=int, default=1000,
+                  help="distinct date values")
+    op.add_option("-c", "--concurrency", action="store", type=int, default=4)
+    op.add_option("--client_ids", action="store", type=int, default=10,
+                  help="client ids per client_instrests request")
+    op.add_option("--clients", action="store", type=int, default=10000,
+                  help="clients in the store")
+    op.add_option("--score_share", action="store", type=float, default=0.5,
+                  help="share of online_score requests")
+    op.add_option("--tarantool", action="store_true", default=False)
+    op.add_option("--tarantool_host", action="store", default="localhost")
+    op.add_option("--tarantool_port", action="store", type=int, default=3301)
+    op.add_option("--save", action="store", default=None,
+                  help="save results as a baseline")
+    op.add_option("--baseline", action="store", default=None,
+                  help="fail if results regressed against this baseline")
+    op.add_option("--tolerance", action="store", type=float, default=0.1)
+    (opts, args) = op.parse_args()
+
+    if len(args) != 1 or args[0] not in BENCHMARKS:
+        op.error("benchmark name required")
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(0)
+    result = BENCHMARKS[args[0]](opts)
+
+    if result and opts.save:
+        with open(opts.save, "w") as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if result and opts.baseline and not check_baseline(result, opts):
+        sys.exit(1)
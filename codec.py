@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+JSON codec shared by the API and scoring: uses the fastest JSON module
+available (ujson, simplejson), falls back to stdlib json.
+"""
+
+try:
+    import ujson as backend
+except ImportError:
+    try:
+        import simplejson as backend
+    except ImportError:
+        import json as backend
+
+BACKEND = backend.__name__
+
+
+class RawJSON(getattr(backend, 'RawJSON', object)):
+    """
+    Already serialized JSON, embedded into `dumps` output as is.
+    ujson picks it up via __json__, simplejson natively,
+    for stdlib json `dumps` encodes containers itself.
+    """
+
+    def __init__(self, encoded_json):
+        self.encoded_json = encoded_json
+
+    def __json__(self):
+        return self.encoded_json
+
+    def __eq__(self, other):
+        return isinstance(other, RawJSON) and self.encoded_json == other.encoded_json
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return self.encoded_json
+
+
+def loads(s):
+    return backend.loads(s)
+
+
+def dumps(obj):
+    try:
+        return backend.dumps(obj)
+    except TypeError:
+        # stdlib json does not know RawJSON
+        chunks = []
+        _encode(obj, chunks)
+        return ''.join(chunks)
+
+
+def _encode_key(key):
+    if isinstance(key, basestring):
+        return key
+    if key is True:
+        return 'true'
+    if key is False:
+        return 'false'
+    if key is None:
+        return 'null'
+    if isinstance(key, float):
+        return repr(key)
+    return str(key)
+
+
+def _encode(obj, chunks):
+    if isinstance(obj, RawJSON):
+        chunks.append(obj.encoded_json)
+    elif isinstance(obj, dict):
+        chunks.append('{')
+        for i, (k, v) in enumerate(obj.iteritems()):
+            if i:
+                chunks.append(', ')
+            chunks.append(backend.dumps(_encode_key(k)))
+            chunks.append(': ')
+            _encode(v, chunks)
+        chunks.append('}')
+    elif isinstance(obj, (list, tuple)):
+        chunks.append('[')
+        for i, v in enumerate(obj):
+            if i:
+                chunks.append(', ')
+            _encode(v, chunks)
+        chunks.append(']')
+    else:
+        chunks.append(backend.dumps(obj))
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bulk loader of client interests.
+
+    python load_interests.py interests.jsonl
+    python load_interests.py --format csv interests.csv
+    python load_interests.py - < interests.jsonl
+
+JSONL: one {"client_id": 1, "interests": ["cars", "pets"]} object per line.
+CSV: client id followed by the interests, one per column.
+
+The file is streamed: records are read, encoded and grouped into batches
+of --batch_size lazily, at most --workers * 2 batches wait to be written -
+memory use does not depend on the file size. Batches are written with
+set_many by --workers threads, each on its own Tarantool connection.
+"""
+
+import csv
+import logging
+import sys
+import threading
+import time
+import Queue
+from optparse import OptionParser
+
+import codec
+import scoring
+import store
+
+FORMATS = ('jsonl', 'csv')
+
+
+def read_jsonl(lines):
+    for n, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = codec.loads(line)
+            interests = record["interests"]
+            if not isinstance(interests, list) or not all(isinstance(i, basestring) for i in interests):
+                raise TypeError("interests must be a list of strings")
+            yield int(record["client_id"]), interests
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning("line %s skipped: %s", n, e)
+
+
+def read_csv(lines):
+    for n, row in enumerate(csv.reader(lines), 1):
+        if not row:
+            continue
+        try:
+            yield int(row[0]), [v.decode('utf-8') for v in row[1:] if v]
+        except (ValueError, UnicodeDecodeError) as e:
+            logging.warning("line %s skipped: %s", n, e)
+
+
+READERS = {
+    'jsonl': read_jsonl,
+    'csv': read_csv,
+}
+
+
+def encode(records, db=None):
+    """
+    (client id, interests) -> store (key, value). Values are JSON text,
+    or vocabulary ids of `db` when it is given.
+    """
+    for cid, interests in records:
+        if db is not None:
+            yield "i:%s" % cid, scoring.encode_interests(db, interests)
+        else:
+            yield "i:%s" % cid, codec.dumps(interests)
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Progress(object):
+    """Counts written records, logs the rate every `interval` seconds"""
+
+    def __init__(self, interval=5):
+        self.written = 0
+        self.batches = 0
+        self.started = time.time()
+        self._interval = interval
+        self._reported = self.started
+        self._lock = threading.Lock()
+
+    def add(self, n):
+        with self._lock:
+            self.written += n
+            self.batches += 1
+            now = time.time()
+            if now - self._reported < self._interval:
+                return
+            self._reported = now
+        logging.info("%s records written, %.0f records/s", self.written, self.rate())
+
+    def rate(self):
+        elapsed = time.time() - self.started
+        return self.written / elapsed if elapsed > 0 else 0.0
+
+
+def load(db, items, batch_size=1000, workers=4, progress=None, write=None):
+    """
+    Writes (key, value) `items` to `db` with set_many from `workers`
+    threads - or passes batches of `items` to `write` when it is given.
+    Stops at the first store error and raises it.
+    """
+    progress = progress or Progress()
+    write_batch = write or db.set_many
+    queue = Queue.Queue(workers * 2)
+    errors = []
+
+    def writer():
+        while True:
+            batch = queue.get()
+            if batch is None:
+                return
+            if errors:
+                continue
+            try:
+                write_batch(batch)
+            except Exception as e:
+                errors.append(e)
+                continue
+            progress.add(len(batch))
+
+    threads = [threading.Thread(target=writer, name='loader-%s' % i) for i in xrange(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    try:
+        for batch in batches(items, batch_size):
+            if errors:
+                break
+            queue.put(batch)
+    finally:
+        for _ in threads:
+            queue.put(None)
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    return progress
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] FILE|-")
+    op.add_option("-f", "--format", action="store", type="choice",
+                  choices=FORMATS, default='jsonl')
+    op.add_option("-b", "--batch_size", action="store", type=int, default=1000)
+    op.add_option("-w", "--workers", action="store", type=int, default=4,
+                  help="parallel connections")
+    op.add_option("--dictionary", action="store_true", default=False,
+                  help="store vocabulary ids instead of JSON text")
+    op.add_option("--progress_interval", action="store", type=int, default=5,
+                  help="seconds between progress reports")
+    op.add_option("--tarantool_host", action="store", default='localhost')
+    op.add_option("--tarantool_port", action="store", type=int, default=3301)
+    op.add_option("--tarantool_login", action="store", default='score_user')
+    op.add_option("--tarantool_password", action="store", default='score_pass')
+    (opts, args) = op.parse_args()
+
+    if len(args) != 1:
+        op.error("input file required")
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+
+    db = store.StoreTarantoolPool(min_size=opts.workers,
+                                  max_size=opts.workers,
+                                  host=opts.tarantool_host,
+                                  port=opts.tarantool_port,
+                                  user=opts.tarantool_login,
+                                  password=opts.tarantool_password)
+
+    f = sys.stdin if args[0] == '-' else open(args[0], 'rb')
+    try:
+        items = encode(READERS[opts.format](f), db if opts.dictionary else None)
+        progress = load(db, items, opts.batch_size, opts.workers, Progress(opts.progress_interval))
+    except store.StoreError as e:
+        logging.error("loading failed: %s", e)
+        sys.exit(1)
+    finally:
+        f.close()
+        db.close()
+
+    logging.info("done: %s records in %.1fs, %.0f records/s",
+                 progress.written, time.time() - progress.started, progress.rate())
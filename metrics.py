@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-process metrics: counters, histograms and gauges, rendered in
+Prometheus text format. Every process has its own registry - in prefork
+mode each worker reports its own numbers.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in items)
+
+
+class Counter(object):
+
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield '%s%s %s' % (name, _format_labels(labels), self.value)
+
+
+class Gauge(object):
+    """Value read from `func` when metrics are rendered"""
+
+    kind = 'gauge'
+
+    def __init__(self, func):
+        self._func = func
+
+    def samples(self, name, labels):
+        yield '%s%s %s' % (name, _format_labels(labels), self._func())
+
+
+class Histogram(object):
+
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+
+        cumulative = 0
+        for bound, n in zip(self.buckets + ('+Inf',), counts):
+            cumulative += n
+            yield '%s_bucket%s %s' % (name, _format_labels(labels, [('le', bound)]), cumulative)
+        yield '%s_sum%s %s' % (name, _format_labels(labels), total)
+        yield '%s_count%s %s' % (name, _format_labels(labels), count)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = {} # name -> (kind, help, {labels: metric})
+        self._lock = threading.Lock()
+
+    def _get(self, name, help, labels, factory):
+        key = tuple(sorted(labels.iteritems()))
+        family = self._metrics.get(name)
+        if family is not None:
+            metric = family[2].get(key)
+            if metric is not None:
+                return metric
+
+        with self._lock:
+            metric = factory()
+            family = self._metrics.setdefault(name, (metric.kind, help, {}))
+            return family[2].setdefault(key, metric)
+
+    def counter(self, name, help='', **labels):
+        return self._get(name, help, labels, Counter)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(name, help, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name, func, help='', **labels):
+        return self._get(name, help, labels, lambda: Gauge(func))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            families = sorted((name, kind, help, dict(metrics))
+                              for name, (kind, help, metrics) in self._metrics.iteritems())
+
+        for name, kind, help, metrics in families:
+            if help:
+                lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, metric in sorted(metrics.iteritems()):
+                lines.extend(metric.samples(name, labels))
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
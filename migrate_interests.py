@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Migrates client interests stored as JSON text to vocabulary ids.
+
+    python migrate_interests.py
+    python migrate_interests.py --dry_run
+
+Scans the data space page by page, re-encodes every "i:<cid>" value that
+is still JSON and writes it back with compare_and_set_many (see
+load_interests.py): a value changed since the scan read it is left as is,
+so the server may keep writing meanwhile. Already migrated values are
+skipped, so the migration can be interrupted and run again. The server
+reads both formats meanwhile.
+"""
+
+import logging
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+import codec
+import load_interests
+import scoring
+import store
+
+
+class MigrationStats(object):
+
+    def __init__(self):
+        self.scanned = 0
+        self.migrated = 0
+        self.invalid = 0
+        self.changed = 0
+        self.json_bytes = 0
+        # the scan and the writer threads update the counts
+        self.lock = threading.Lock()
+
+
+def migrated(db, pages, stats, encode=True):
+    """
+    Yields (key, JSON value, ids) for JSON interests found in `pages`
+    of (key, value). Values the server reads as no interests - not a JSON
+    list of strings - are counted as invalid and skipped. Without `encode`
+    ids are None and the vocabulary is not touched.
+    """
+    for page in pages:
+        for key, value in page:
+            with stats.lock:
+                stats.scanned += 1
+            if not key.startswith("i:") or not isinstance(value, basestring):
+                continue
+            try:
+                interests = codec.loads(value) if value else []
+            except ValueError:
+                interests = None
+            if not isinstance(interests, list) or not all(isinstance(i, basestring) for i in interests):
+                with stats.lock:
+                    stats.invalid += 1
+                logging.warning("%s skipped: not a JSON list of strings", key)
+                continue
+
+            with stats.lock:
+                stats.migrated += 1
+                stats.json_bytes += len(value)
+            yield key, value, scoring.encode_interests(db, interests) if encode else None
+
+
+def migrate(db, batch_size=1000, workers=4, dry_run=False, progress=None):
+    stats = MigrationStats()
+    items = migrated(db, db.iter_data(batch_size), stats, encode=not dry_run)
+    if dry_run:
+        for _ in items:
+            pass
+        return stats
+
+    def write(batch):
+        written = db.compare_and_set_many(batch)
+        with stats.lock:
+            # rewritten by someone else since the scan
+            stats.changed += len(batch) - len(written)
+            stats.migrated -= len(batch) - len(written)
+
+    load_interests.load(db, items, batch_size, workers, progress, write)
+    return stats
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-b", "--batch_size", action="store", type=int, default=1000)
+    op.add_option("-w", "--workers", action="store", type=int, default=4,
+                  help="parallel connections")
+    op.add_option("--dry_run", action="store_true", default=False,
+                  help="only count values to migrate, nothing is written")
+    op.add_option("--progress_interval", action="store", type=int, default=5,
+                  help="seconds between progress reports")
+    op.add_option("--tarantool_host", action="store", default='localhost')
+    op.add_option("--tarantool_port", action="store", type=int, default=3301)
+    op.add_option("--tarantool_login", action="store", default='score_user')
+    op.add_option("--tarantool_password", action="store", default='score_pass')
+    (opts, args) = op.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+
+    # one more connection for the scan
+    db = store.StoreTarantoolPool(min_size=opts.workers + 1,
+                                  max_size=opts.workers + 1,
+                                  host=opts.tarantool_host,
+                                  port=opts.tarantool_port,
+                                  user=opts.tarantool_login,
+                                  password=opts.tarantool_password)
+
+    started = time.time()
+    try:
+        stats = migrate(db, opts.batch_size, opts.workers, opts.dry_run,
+                        load_interests.Progress(opts.progress_interval))
+    except store.StoreError as e:
+        logging.error("migration failed: %s", e)
+        sys.exit(1)
+    finally:
+        db.close()
+
+    logging.info("done in %.1fs: %s tuples scanned, %s interests %s (%s bytes of JSON), "
+                 "%s invalid, %s changed meanwhile",
+                 time.time() - started, stats.scanned, stats.migrated,
+                 "to migrate" if opts.dry_run else "migrated", stats.json_bytes, stats.invalid,
+                 stats.changed)
@@ -2,27 +2,76 @@
 # -*- coding: utf-8 -*-
 
 import hashlib
-import json
+import logging
+import threading
+import weakref
 
+import codec
+import metrics
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+
+class CacheStats(object):
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+
+score_cache_stats = CacheStats()
+
+metrics.registry.gauge("score_cache_hits", lambda: score_cache_stats.hits)
+metrics.registry.gauge("score_cache_misses", lambda: score_cache_stats.misses)
+metrics.registry.gauge("score_cache_hit_rate", lambda: score_cache_stats.hit_rate)
+
+
+def get_score_key(phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    # every scoring input takes part in the key, 
+    # None and empty values are the same
     key_parts = [
-        first_name or "",
-        last_name or "",
-        birthday.strftime("%Y%m%d"),
+        phone,
+        email,
+        birthday.strftime("%Y%m%d") if birthday else None,
+        gender,
+        first_name,
+        last_name,
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
+    key = u"|".join(u"" if p is None else unicode(p) for p in key_parts)
+    return "uid:" + hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(phone, email, birthday, gender, first_name, last_name)
     
     # try get from cache,
     # fallback to heavy calculation in case of cache miss
-    
-    try:
-        score = store.cache_get(key)
-    except Exception:
-        score = 0
+    score = None
+    if store is not None:
+        try:
+            score = store.cache_get(key)
+        except Exception as e:
+            logging.error("score cache read error: %s", e)
+
+        if score is not None:
+            score_cache_stats.hit()
+            return score
 
-    if score:
-        return score
+        score_cache_stats.miss()
+
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -33,15 +82,127 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 0.5
     
     # cache for 60 minutes
-    try:
-        store.cache_set(key, score,  60 * 60)
-    except Exception:
-        pass
+    if store is not None:
+        try:
+            store.cache_set(key, score,  60 * 60)
+        except Exception as e:
+            logging.error("score cache write error: %s", e)
 
     return score
 
 
+class Vocabulary(object):
+    """
+    Interest names by id, from the vocabulary of a store. Loaded on first
+    use and reloaded when an unknown id is met - ids never change, names
+    added by other processes are picked up this way. Ids of new names are
+    assigned by the store.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._names = None # id -> name
+        self._ids = {}     # name -> id
+        self._lock = threading.Lock()
+
+    def _load(self):
+        names = self._store.get_vocabulary()
+        with self._lock:
+            self._names = names
+            self._ids = dict((name, i) for i, name in names.iteritems())
+
+    def decode(self, ids):
+        names = self._names
+        if names is not None:
+            try:
+                return [names[i] for i in ids]
+            except KeyError:
+                pass
+
+        self._load()
+        names = self._names
+
+        result = [names[i] for i in ids if i in names]
+        if len(result) != len(ids):
+            logging.warning('unknown interest ids: %s', [i for i in ids if i not in names])
+        return result
+
+    def encode(self, interests):
+        missing = [name for name in interests if name not in self._ids]
+        if missing:
+            added = self._store.add_vocabulary(missing)
+            with self._lock:
+                ids = dict(self._ids)
+                ids.update(added)
+                self._ids = ids
+                # decode reloads the names when it meets the new ids
+        ids = self._ids
+        return [ids[name] for name in interests]
+
+
+_vocabularies = weakref.WeakKeyDictionary()
+_vocabularies_lock = threading.Lock()
+
+def get_vocabulary(store):
+    vocabulary = _vocabularies.get(store)
+    if vocabulary is None:
+        with _vocabularies_lock:
+            vocabulary = _vocabularies.setdefault(store, Vocabulary(store))
+    return vocabulary
+
+
+def encode_interests(store, interests):
+    """Interest names -> list of vocabulary ids, to be stored instead of JSON"""
+    return get_vocabulary(store).encode(interests)
+
+
+def _loads_interests(value):
+    try:
+        interests = codec.loads(value)
+    except ValueError:
+        interests = None
+    if not isinstance(interests, list):
+        logging.error('invalid stored interests: %r', value[:100])
+        return []
+    return interests
+
+
+def decode_interests(store, value):
+    """
+    Stored interests - list of vocabulary ids or JSON text - to names.
+    Text that is not a JSON list is logged and read as no interests.
+    """
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        return _loads_interests(value)
+    return get_vocabulary(store).decode(value)
+
+
 def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
-    
-    return json.loads(r) if r else []
\ No newline at end of file
+    return decode_interests(store, store.get("i:%s" % cid))
+
+
+EMPTY_INTERESTS = codec.RawJSON('[]')
+
+def get_interests_many(store, cids, raw=False):
+    """
+    Interests of every client in `cids`. With raw=True stored JSON
+    is checked but not re-encoded - returned as codec.RawJSON (vocabulary 
+    ids are always decoded).
+    """
+    keys = dict(("i:%s" % cid, cid) for cid in cids)
+    values = store.get_many(keys.keys())
+
+    result = {}
+    for key, cid in keys.iteritems():
+        r = values.get(key)
+        if not r:
+            result[cid] = EMPTY_INTERESTS if raw else []
+        elif raw and isinstance(r, basestring):
+            # never embed a fragment that is not valid JSON
+            result[cid] = codec.RawJSON(r) if _loads_interests(r) else EMPTY_INTERESTS
+        else:
+            result[cid] = decode_interests(store, r)
+
+    return result
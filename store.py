@@ -1,23 +1,630 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # 
+import abc
 import logging
+import shelve
+import socket
+import threading
 import warnings
-import datetime
 import time
-from collections import namedtuple
+import Queue
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 
 import tarantool
 
+import metrics
+import tracing
+
 CacheRecord = namedtuple('CacheRecord', ('key','value','ctime', 'ttl'))
 DataRecord = namedtuple('DataRecord', ('key','value'))
 
 warnings.simplefilter("ignore")
 
+# fetches many keys from a space in one round trip
+GET_MANY_LUA = """
+local space_name, keys = ...
+local space = box.space[space_name]
+local result = {}
+for _, key in ipairs(keys) do
+    local t = space:get(key)
+    if t ~= nil then
+        result[#result + 1] = t
+    end
+end
+return result
+"""
+# replaces many tuples in a space in one round trip and one transaction
+REPLACE_MANY_LUA = """
+local space_name, tuples = ...
+local space = box.space[space_name]
+box.begin()
+for _, t in ipairs(tuples) do
+    space:replace(t)
+end
+box.commit()
+return #tuples
+"""
+# replaces data tuples whose value is still the expected one, in one
+# round trip and one transaction; returns the keys written
+COMPARE_AND_REPLACE_MANY_LUA = """
+local items = ...
+local space = box.space.data
+local written = {}
+box.begin()
+for _, item in ipairs(items) do
+    local t = space:get(item[1])
+    if t ~= nil and t[2] == item[2] then
+        space:replace({item[1], item[3]})
+        written[#written + 1] = item[1]
+    end
+end
+box.commit()
+return written
+"""
+# next page of a full scan: up to `limit` tuples after key `after` 
+# ('' - from the start)
+SCAN_LUA = """
+local space_name, after, limit = ...
+local index = box.space[space_name].index.primary
+local result = {}
+local start, iterator = nil, 'ALL'
+if after ~= '' then
+    start, iterator = after, 'GT'
+end
+for _, t in index:pairs(start, {iterator = iterator}) do
+    if #result >= limit then
+        break
+    end
+    result[#result + 1] = t
+end
+return result
+"""
+# returns ids of interest names, adding the missing ones to the vocabulary
+VOCABULARY_ADD_LUA = """
+local names = ...
+local space = box.space.vocabulary
+local result = {}
+for _, name in ipairs(names) do
+    local t = space.index.name:get(name)
+    if t == nil then
+        local last = space.index.primary:max()
+        t = space:insert({last == nil and 1 or last[1] + 1, name})
+    end
+    result[name] = t[1]
+end
+return result
+"""
+# defines cache_expire_once(now, max_size, chunk) and starts (once per 
+# tarantool instance) the fiber calling it every `interval` seconds: 
+# removes expired tuples, then evicts the oldest ones while the space 
+# holds more than `max_size` tuples (0 - no limit). Tuples are scanned and 
+# deleted `chunk` at a time, yielding in between, so that a pass over a 
+# large cache does not block other requests.
+CACHE_EXPIRE_LUA = """
+local interval, max_size, chunk = ...
+local fiber = require('fiber')
+
+box.space.cache:create_index('ctime', { type = 'TREE', unique = false, parts = {3, 'unsigned'}, if_not_exists = true })
+
+function cache_expire_once(now, max_size, chunk)
+    chunk = chunk or 1000
+    local space = box.space.cache
+    local expired, evicted = 0, 0
+
+    -- the scan resumes after the last scanned key, so when that one
+    -- has expired it is deleted along with the next chunk
+    local last, carry = nil, nil
+    repeat
+        local keys, scanned = {}, 0
+        local iterator = last == nil and 'ALL' or 'GT'
+        for _, t in space.index.primary:pairs(last, {iterator = iterator}) do
+            if scanned >= chunk then
+                break
+            end
+            scanned = scanned + 1
+            last = t[1]
+            if t[4] > 0 and now - t[3] >= t[4] then
+                keys[#keys + 1] = t[1]
+            end
+        end
+
+        local next_carry = nil
+        if scanned >= chunk and keys[#keys] == last then
+            next_carry = table.remove(keys)
+        end
+        if carry ~= nil then
+            keys[#keys + 1] = carry
+        end
+        carry = next_carry
+
+        for _, key in ipairs(keys) do
+            space:delete(key)
+        end
+        expired = expired + #keys
+        fiber.yield()
+    until scanned < chunk
+
+    while max_size > 0 and space:len() > max_size do
+        local keys = {}
+        local excess = math.min(space:len() - max_size, chunk)
+        for _, t in space.index.ctime:pairs() do
+            if #keys >= excess then
+                break
+            end
+            keys[#keys + 1] = t[1]
+        end
+        for _, key in ipairs(keys) do
+            space:delete(key)
+        end
+        evicted = evicted + #keys
+        fiber.yield()
+    end
+
+    return expired, evicted
+end
+
+cache_expire_settings = { interval = interval, max_size = max_size, chunk = chunk }
+
+if interval > 0 and (cache_expire_fiber == nil or cache_expire_fiber:status() == 'dead') then
+    cache_expire_fiber = fiber.create(function()
+        fiber.name('cache_expire')
+        while cache_expire_settings.interval > 0 do
+            fiber.sleep(cache_expire_settings.interval)
+            local ok, err = pcall(cache_expire_once, math.floor(fiber.time()), 
+                                  cache_expire_settings.max_size,
+                                  cache_expire_settings.chunk)
+            if not ok then
+                require('log').error('cache expiration failed: %s', err)
+            end
+        end
+    end)
+end
+"""
+
+
 class StoreError(Exception):
     pass
 
-class StoreTarantool(object):
+
+_write_listeners = []
+
+def add_write_listener(func):
+    """`func(keys)` is called after any store of this process writes data keys"""
+    _write_listeners.append(func)
+
+
+def _written(keys):
+    for func in _write_listeners:
+        func(keys)
+
+
+class BaseStore(object):
+    """
+    Store interface: persistent key-value data (get/set) and a cache with
+    per-key ttl (cache_get/cache_set). Batch operations default to 
+    one call per key. Wrappers must forward every abstract method - 
+    a missing one fails at construction, not on the first call.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def get(self, key):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def set(self, key, value):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def cache_get(self, key):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def cache_set(self, key, value, ttl=0):
+        raise NotImplementedError()
+
+    def get_many(self, keys):
+        """Returns dict key -> value for the keys found"""
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def cache_get_many(self, keys):
+        """Returns dict key -> value for the cached keys"""
+        result = {}
+        for key in keys:
+            value = self.cache_get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def cache_get_entry(self, key):
+        """
+        Returns (value, seconds left to live - 0 if unknown or unlimited) 
+        for a cached key, None otherwise
+        """
+        value = self.cache_get(key)
+        return None if value is None else (value, 0)
+
+    def cache_get_entries(self, keys):
+        """Returns dict key -> (value, seconds left to live) for the cached keys"""
+        result = {}
+        for key in keys:
+            entry = self.cache_get_entry(key)
+            if entry is not None:
+                result[key] = entry
+        return result
+
+    def set_many(self, items):
+        """Writes (key, value) pairs"""
+        for key, value in items:
+            self.set(key, value)
+
+    def cache_set_many(self, items):
+        """Caches (key, value, ttl) triples"""
+        for key, value, ttl in items:
+            self.cache_set(key, value, ttl)
+
+    @abc.abstractmethod
+    def compare_and_set_many(self, items):
+        """
+        Atomically writes `value` of (key, expected, value) triples whose 
+        key still holds `expected`. Returns the list of keys written.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def iter_data(self, batch_size=1000):
+        """Yields lists of up to `batch_size` (key, value) data pairs"""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def get_vocabulary(self):
+        """Returns dict id -> interest name"""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def add_vocabulary(self, names):
+        """Returns dict name -> id, assigning ids to new names"""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class LRUCache(object):
+    """
+    Thread-safe in-process cache, bounded by `max_size` entries, 
+    least recently used entries are evicted first. Every entry expires 
+    after its own ttl (seconds, 0 - `default_ttl`).
+    """
+
+    def __init__(self, max_size=1024, default_ttl=60):
+        self._max_size = max_size
+        self._default_ttl = default_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return None if entry is None else entry[0]
+
+    def get_entry(self, key):
+        """Returns (value, seconds left to live) or None"""
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            left = expires - time.time()
+            if left < 0:
+                self.misses += 1
+                return None
+
+            # re-insert as the most recently used
+            self._data[key] = (expires, value)
+            self.hits += 1
+            return value, left
+
+    def set(self, key, value, ttl=0):
+        expires = time.time() + (ttl or self._default_ttl)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self._max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class L1CacheStore(BaseStore):
+    """
+    Wraps a store, serving cache_get from an in-process LRUCache first.
+    Entries live for the ttl given to cache_set (or, when read from the 
+    wrapped store, for the rest of its ttl there), but never longer than 
+    `max_ttl` - values cached by other processes are not seen until then.
+    Other operations go straight to the wrapped store.
+    """
+
+    def __init__(self, store, max_size=1024, max_ttl=60):
+        self.store = store
+        self._max_ttl = max_ttl
+        self.l1 = LRUCache(max_size, default_ttl=max_ttl)
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def get_many(self, keys):
+        return self.store.get_many(keys)
+
+    def set(self, key, value):
+        return self.store.set(key, value)
+
+    def set_many(self, items):
+        return self.store.set_many(items)
+
+    def compare_and_set_many(self, items):
+        return self.store.compare_and_set_many(items)
+
+    def iter_data(self, batch_size=1000):
+        return self.store.iter_data(batch_size)
+
+    def get_vocabulary(self):
+        return self.store.get_vocabulary()
+
+    def add_vocabulary(self, names):
+        return self.store.add_vocabulary(names)
+
+    def _l1_ttl(self, ttl):
+        return min(ttl, self._max_ttl) if ttl > 0 else self._max_ttl
+
+    def cache_get(self, key):
+        entry = self.cache_get_entry(key)
+        return None if entry is None else entry[0]
+
+    def cache_get_entry(self, key):
+        entry = self.l1.get_entry(key)
+        if entry is not None:
+            return entry
+
+        entry = self.store.cache_get_entry(key)
+        if entry is not None:
+            self.l1.set(key, entry[0], self._l1_ttl(entry[1]))
+        return entry
+
+    def cache_get_many(self, keys):
+        return dict((key, value) for key, (value, _) in self.cache_get_entries(keys).iteritems())
+
+    def cache_get_entries(self, keys):
+        result = {}
+        misses = []
+        for key in keys:
+            entry = self.l1.get_entry(key)
+            if entry is not None:
+                result[key] = entry
+            else:
+                misses.append(key)
+
+        if misses:
+            found = self.store.cache_get_entries(misses)
+            for key, (value, ttl) in found.iteritems():
+                self.l1.set(key, value, self._l1_ttl(ttl))
+            result.update(found)
+        return result
+
+    def cache_set(self, key, value, ttl=0):
+        result = self.store.cache_set(key, value, ttl)
+        self.l1.set(key, value, self._l1_ttl(ttl))
+        return result
+
+    def close(self):
+        self.store.close()
+
+    def stats(self):
+        return self.l1.stats()
+
+
+class WriteBehindStore(BaseStore):
+    """
+    Wraps a store, making cache_set asynchronous: writes are queued and a
+    background thread flushes them with cache_set_many, in batches of up 
+    to `batch_size`, waiting `flush_interval` seconds for a batch to fill.
+
+    A key written again before it is flushed replaces the queued value. 
+    While more than `max_queue` keys wait, new keys are dropped (the value
+    is simply computed again on the next miss). Queued values are served
+    by cache_get. close() flushes everything queued.
+    """
+
+    def __init__(self, store, max_queue=10000, batch_size=100, flush_interval=0.01):
+        self.store = store
+        self._max_queue = max_queue
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+
+        self._pending = OrderedDict() # key -> (value, ttl)
+        self._flushing = {}           # key -> (value, ttl), being written
+        self._lock = threading.Lock()
+        self._queued = threading.Condition(self._lock)
+        self._writer = None
+        self._closing = False
+
+        self._stats = {
+            'coalesced': 0,
+            'dropped': 0,
+            'flushed': 0,
+            'failed': 0,
+        }
+        metrics.registry.gauge('write_behind_queue', lambda: len(self._pending),
+                               'Cache writes waiting to be flushed')
+        self._dropped = metrics.registry.counter('write_behind_dropped', 
+                                                 'Cache writes dropped on a full queue')
+
+    def _start(self):
+        # started on first use - so that forked workers get their own
+        self._writer = threading.Thread(target=self._write, name='cache-write-behind')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def get_many(self, keys):
+        return self.store.get_many(keys)
+
+    def set(self, key, value):
+        return self.store.set(key, value)
+
+    def set_many(self, items):
+        return self.store.set_many(items)
+
+    def compare_and_set_many(self, items):
+        return self.store.compare_and_set_many(items)
+
+    def iter_data(self, batch_size=1000):
+        return self.store.iter_data(batch_size)
+
+    def get_vocabulary(self):
+        return self.store.get_vocabulary()
+
+    def add_vocabulary(self, names):
+        return self.store.add_vocabulary(names)
+
+    def _queued_value(self, key):
+        return self._pending.get(key) or self._flushing.get(key)
+
+    def cache_get(self, key):
+        queued = self._queued_value(key)
+        if queued is not None:
+            return queued[0]
+        return self.store.cache_get(key)
+
+    def cache_get_entry(self, key):
+        # a queued value has (about) all of its ttl left
+        return self._queued_value(key) or self.store.cache_get_entry(key)
+
+    def cache_get_many(self, keys):
+        return dict((key, value) for key, (value, _) in self.cache_get_entries(keys).iteritems())
+
+    def cache_get_entries(self, keys):
+        result = {}
+        misses = []
+        for key in keys:
+            queued = self._queued_value(key)
+            if queued is not None:
+                result[key] = queued
+            else:
+                misses.append(key)
+
+        if misses:
+            result.update(self.store.cache_get_entries(misses))
+        return result
+
+    def cache_set(self, key, value, ttl=0):
+        self.cache_set_many([(key, value, ttl)])
+
+    def cache_set_many(self, items):
+        with self._lock:
+            if self._closing:
+                raise StoreError('store is closed')
+            if self._writer is None:
+                self._start()
+
+            for key, value, ttl in items:
+                if key in self._pending:
+                    self._stats['coalesced'] += 1
+                elif len(self._pending) >= self._max_queue:
+                    self._stats['dropped'] += 1
+                    self._dropped.inc()
+                    continue
+                self._pending[key] = (value, ttl)
+
+            self._queued.notify()
+
+    def _write(self):
+        while True:
+            with self._lock:
+                while not self._pending and not self._closing:
+                    self._queued.wait()
+                if not self._pending:
+                    return
+
+            if not self._closing and len(self._pending) < self._batch_size:
+                time.sleep(self._flush_interval)
+
+            with self._lock:
+                batch = []
+                while self._pending and len(batch) < self._batch_size:
+                    key, (value, ttl) = self._pending.popitem(last=False)
+                    batch.append((key, value, ttl))
+                    self._flushing[key] = (value, ttl)
+
+            try:
+                self.store.cache_set_many(batch)
+                flushed, failed = len(batch), 0
+            except Exception as e:
+                logging.error('cache write-behind flush error: %s', e)
+                flushed, failed = 0, len(batch)
+
+            with self._lock:
+                self._flushing = {}
+                self._stats['flushed'] += flushed
+                self._stats['failed'] += failed
+
+    def close(self):
+        """Writes out everything queued, then closes the wrapped store"""
+        with self._lock:
+            self._closing = True
+            writer, self._writer = self._writer, None
+            self._queued.notify()
+        if writer is not None:
+            writer.join()
+        self.store.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queued'] = len(self._pending)
+        stats['max_queue'] = self._max_queue
+        return stats
+
+
+class StoreTarantool(BaseStore):
+    """
+    Tarantool-backed store.
+
+    Connection failures are detected lazily: an operation that fails with
+    a network error reconnects and is retried up to `retry_attempts` times.
+    With `keepalive_interval` set, a background thread pings connections 
+    that were idle for that long.
+    """
     
     def __init__(self, 
                  host='localhost', 
@@ -27,6 +634,11 @@ class StoreTarantool(object):
                  reconnect_max_attempts=10,
                  reconnect_delay=1, #seconds
                  connection_timeout=10, # seconds
+                 retry_attempts=1,
+                 keepalive_interval=0, # seconds, 0 - no keepalive
+                 cache_expire_interval=60, # seconds, 0 - no server-side expiration
+                 cache_max_size=0, # tuples, 0 - no limit
+                 cache_expire_chunk=1000, # tuples scanned between yields
                  ):
 
         self._host = host        
@@ -36,53 +648,129 @@ class StoreTarantool(object):
         self._reconnect_max_attempts = reconnect_max_attempts
         self._reconnect_delay = reconnect_delay
         self._connection_timeout = connection_timeout
+        self._retry_attempts = retry_attempts
+        self._keepalive_interval = keepalive_interval
+        self._cache_max_size = cache_max_size
+        self._cache_expire_chunk = cache_expire_chunk
+
+        # one connection is one socket - operations must not interleave
+        self._lock = threading.RLock()
+        self._last_used = time.time()
+        self._closed = threading.Event()
 
         self.db = None
-        self._refresh_connection()
+        self._connect()
         
         # creating spaces if there are none
         try:
-            self.data_space = self.db.space('data')
+            self.db.space('data')
         except tarantool.SchemaError:
             self.db.eval("box.schema.space.create('data')")
             self.db.eval("box.space.data:create_index('primary', { type = 'HASH', parts = {1, 'string'}})")
-            self.data_space = self.db.space('data')
 
         try:
-            self.cache_space = self.db.space('cache')
+            self.db.space('cache')
         except tarantool.SchemaError:
             self.db.eval("box.schema.space.create('cache')")
             self.db.eval("box.space.cache:create_index('primary', { type = 'HASH', parts = {1, 'string'}})")
-            self.cache_space = self.db.space('cache')
+
+        try:
+            self.db.space('vocabulary')
+        except tarantool.SchemaError:
+            self.db.eval("box.schema.space.create('vocabulary')")
+            self.db.eval("box.space.vocabulary:create_index('primary', { type = 'TREE', parts = {1, 'unsigned'}})")
+            self.db.eval("box.space.vocabulary:create_index('name', { type = 'HASH', parts = {2, 'string'}})")
+
+        # expired cache tuples are removed on the server side
+        self.db.eval(CACHE_EXPIRE_LUA, (cache_expire_interval, cache_max_size, cache_expire_chunk))
+
+        if self._keepalive_interval > 0:
+            keepalive = threading.Thread(target=self._keepalive, name='tarantool-keepalive')
+            keepalive.daemon = True
+            keepalive.start()
+
+
+    def _connect(self):
+        try:
+            self.db = tarantool.Connection(self._host, self._port, 
+                                           user=self._user, 
+                                           password=self._password,
+                                           socket_timeout=self._connection_timeout, 
+                                           reconnect_max_attempts=self._reconnect_max_attempts,
+                                           reconnect_delay=self._reconnect_delay
+                                           )
+        except tarantool.error.NetworkError as e:
+            logging.error('tarantool connection error: %s', e.message)    
+            self.db = None
+            raise StoreError('tarantool error: %s' % e.message)
 
 
-    def _refresh_connection(self):
-        if self.db:
+    def _execute(self, name, operation, *args):
+        """
+        Runs `operation(connection, *args)`. On network failure drops the 
+        connection, reconnects and retries. Round trip time is recorded 
+        under operation `name`.
+        """
+        attempt = 0
+        timer = metrics.registry.histogram('store_operation_seconds', 
+                                           'Tarantool round trip time', operation=name)
+        with self._lock:
+            while True:
+                if self.db is None:
+                    self._connect()
+                try:
+                    with tracing.span('store.' + name, timer):
+                        result = operation(self.db, *args)
+                    self._last_used = time.time()
+                    return result
+                except (tarantool.error.NetworkError, socket.error) as e:
+                    logging.error('tarantool connection error: %s', e)
+                    self._drop_connection()
+                    if attempt >= self._retry_attempts:
+                        raise StoreError('tarantool error: %s' % e)
+                    attempt += 1
+
+
+    def _drop_connection(self):
+        if self.db is not None:
             try:
-                ping = self.db.ping()
-            except NetworkError as e:
-                logging.error('tarantool connection error: %s', e.message)
-                self.db = None
-       
-        if not self.db:
+                self.db.close()
+            except Exception:
+                pass
+        self.db = None
+
+
+    def _keepalive(self):
+        while not self._closed.wait(self._keepalive_interval):
+            if time.time() - self._last_used < self._keepalive_interval:
+                continue
             try:
-                self.db = tarantool.Connection(self._host, self._port, 
-                                               user=self._user, 
-                                               password=self._password,
-                                               socket_timeout=self._connection_timeout, 
-                                               reconnect_max_attempts=self._reconnect_max_attempts,
-                                               reconnect_delay=self._reconnect_delay
-                                               )
-            except tarantool.error.NetworkError as e:
-                logging.error('tarantool connection error: %s', e.message)    
-                self.db = None
-                raise StoreError('tarantool error: %s', e.message)
+                self._execute('ping', lambda db: db.ping())
+            except StoreError:
+                # next operation will try to reconnect
+                pass
 
 
-    def get(self, key):
-        self._refresh_connection()
+    def cache_expire(self, max_size=None):
+        """
+        Runs one server-side expiration pass right away. 
+        Returns the number of expired and evicted tuples.
+        """
+        if max_size is None:
+            max_size = self._cache_max_size
+        response = self._execute('cache_expire', lambda db: db.eval(
+            "return cache_expire_once(...)", (int(time.time()), max_size, self._cache_expire_chunk)))
+        return tuple(response.data)
+
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self._drop_connection()
 
-        response = self.data_space.select(key)
+
+    def get(self, key):
+        response = self._execute('get', lambda db: db.select('data', key))
         if not len(response.data):
             return None
 
@@ -90,30 +778,494 @@ class StoreTarantool(object):
         return rec.value
 
 
+    def get_many(self, keys):
+        """Returns dict key -> value for the keys found"""
+        if not keys:
+            return {}
+
+        response = self._execute('get_many', lambda db: db.eval(GET_MANY_LUA, ('data', list(keys))))
+        if not response.data:
+            return {}
+
+        return dict(DataRecord(*rec) for rec in response.data[0])
+
+
     def set(self, key, value):
-        self._refresh_connection()
+        result = self._execute('set', lambda db: db.replace('data', (key, value)))
+        _written([key])
+        return result
+
+
+    def set_many(self, items):
+        tuples = [(key, value) for key, value in items]
+        if not tuples:
+            return 0
+
+        result = self._execute('set_many', lambda db: db.eval(REPLACE_MANY_LUA, ('data', tuples)))
+        _written([key for key, _ in tuples])
+        return result
+
+
+    def compare_and_set_many(self, items):
+        items = [list(item) for item in items]
+        if not items:
+            return []
+
+        response = self._execute('compare_and_set_many', 
+                                 lambda db: db.eval(COMPARE_AND_REPLACE_MANY_LUA, (items,)))
+        written = list(response.data[0]) if response.data and response.data[0] else []
+        _written(written)
+        return written
+
+
+    def iter_data(self, batch_size=1000):
+        after = ''
+        while True:
+            response = self._execute('scan', lambda db: db.eval(SCAN_LUA, ('data', after, batch_size)))
+            page = [tuple(DataRecord(*rec)) for rec in response.data[0]] if response.data else []
+            if not page:
+                return
+            yield page
+            after = page[-1][0]
+
+
+    def get_vocabulary(self):
+        response = self._execute('get_vocabulary', lambda db: db.select('vocabulary'))
+        return dict((rec[0], rec[1]) for rec in response.data)
+
 
-        return self.data_space.replace((key, value))
+    def add_vocabulary(self, names):
+        if not names:
+            return {}
+
+        response = self._execute('add_vocabulary', lambda db: db.eval(VOCABULARY_ADD_LUA, (list(names),)))
+        return response.data[0] if response.data else {}
 
 
     def cache_get(self, key):
-        self._refresh_connection()
+        entry = self.cache_get_entry(key)
+        return None if entry is None else entry[0]
+
 
-        response = self.cache_space.select(key)
+    def cache_get_entry(self, key):
+        response = self._execute('cache_get', lambda db: db.select('cache', key))
         if not len(response.data):
             return None
 
-        rec = CacheRecord(*response.data[0])
+        return self._cache_entry(CacheRecord(*response.data[0]))
+
+
+    def cache_get_many(self, keys):
+        return dict((key, value) for key, (value, _) in self.cache_get_entries(keys).iteritems())
+
+
+    def cache_get_entries(self, keys):
+        if not keys:
+            return {}
+
+        response = self._execute('cache_get_many', lambda db: db.eval(GET_MANY_LUA, ('cache', list(keys))))
+        if not response.data:
+            return {}
+
+        result = {}
+        for rec in response.data[0]:
+            rec = CacheRecord(*rec)
+            entry = self._cache_entry(rec)
+            if entry is not None:
+                result[rec.key] = entry
+        return result
+
+
+    @staticmethod
+    def _cache_entry(rec):
+        """(value, seconds left to live) of a cache tuple, None if expired"""
+        if rec.ttl <= 0:
+            return rec.value, 0
+
+        left = rec.ttl - (int(time.time()) - rec.ctime)
+        if left <= 0:
+            return None
+        return rec.value, left
+
+
+    def cache_set(self, key, value, ttl=0):
+        # epoch seconds - the expiration fiber compares them to its clock
+        ctime = int(time.time())
+
+        return self._execute('cache_set', lambda db: db.replace('cache', (key, value, ctime, ttl)))
+
+
+    def cache_set_many(self, items):
+        ctime = int(time.time())
+        tuples = [(key, value, ctime, ttl) for key, value, ttl in items]
+        if not tuples:
+            return 0
+
+        return self._execute('cache_set_many', lambda db: db.eval(REPLACE_MANY_LUA, ('cache', tuples)))
+
+
+class StoreTarantoolPool(BaseStore):
+    """
+    Pool of StoreTarantool connections with the StoreTarantool interface.
+    Every operation checks out an idle connection (opening a new one while
+    the pool is below `max_size`), waiting at most `checkout_timeout` 
+    seconds for one to be returned. Connections idle for longer than 
+    `health_check_interval` are pinged before use.
+    """
+
+    def __init__(self, 
+                 min_size=1, 
+                 max_size=10, 
+                 checkout_timeout=5, # seconds
+                 health_check_interval=30, # seconds, 0 - no checks
+                 **store_params
+                 ):
+
+        self._min_size = min_size
+        self._max_size = max(min_size, max_size)
+        self._checkout_timeout = checkout_timeout
+        self._health_check_interval = health_check_interval
+        self._store_params = store_params
+
+        self._idle = Queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._size = 0
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'created': 0,
+            'discarded': 0,
+            'health_checks': 0,
+        }
+
+        for _ in xrange(self._min_size):
+            self._size += 1
+            self._idle.put(self._create())
+
+
+    def _create(self):
+        conn = StoreTarantool(**self._store_params)
+        with self._lock:
+            self._stats['created'] += 1
+        return conn
+
+
+    def _discard(self, conn):
+        conn.close()
+        with self._lock:
+            self._size -= 1
+            self._stats['discarded'] += 1
+
+
+    def _checkout(self):
+        try:
+            conn = self._idle.get_nowait()
+        except Queue.Empty:
+            with self._lock:
+                grow = self._size < self._max_size
+                if grow:
+                    self._size += 1
+                else:
+                    self._stats['waits'] += 1
+
+            if grow:
+                try:
+                    conn = self._create()
+                except Exception:
+                    with self._lock:
+                        self._size -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self._checkout_timeout)
+                except Queue.Empty:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    raise StoreError('connection pool checkout timeout')
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+
+        if self._health_check_interval > 0 and \
+           time.time() - conn._last_used > self._health_check_interval:
+            with self._lock:
+                self._stats['health_checks'] += 1
+            try:
+                conn._execute('ping', lambda db: db.ping())
+            except StoreError:
+                self._discard(conn)
+                raise
+
+        return conn
+
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+        stats['max_size'] = self._max_size
+        stats['idle'] = self._idle.qsize()
+        stats['in_use'] = stats['size'] - stats['idle']
+        return stats
+
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            self._discard(conn)
+
+
+    def get(self, key):
+        with self.connection() as conn:
+            return conn.get(key)
+
+
+    def get_many(self, keys):
+        with self.connection() as conn:
+            return conn.get_many(keys)
+
+
+    def set(self, key, value):
+        with self.connection() as conn:
+            return conn.set(key, value)
+
+
+    def set_many(self, items):
+        with self.connection() as conn:
+            return conn.set_many(items)
+
+
+    def compare_and_set_many(self, items):
+        with self.connection() as conn:
+            return conn.compare_and_set_many(items)
+
+
+    def iter_data(self, batch_size=1000):
+        # one connection for the whole scan
+        with self.connection() as conn:
+            for page in conn.iter_data(batch_size):
+                yield page
+
+
+    def get_vocabulary(self):
+        with self.connection() as conn:
+            return conn.get_vocabulary()
+
+
+    def add_vocabulary(self, names):
+        with self.connection() as conn:
+            return conn.add_vocabulary(names)
+
+
+    def cache_get(self, key):
+        with self.connection() as conn:
+            return conn.cache_get(key)
+
+
+    def cache_get_many(self, keys):
+        with self.connection() as conn:
+            return conn.cache_get_many(keys)
+
+
+    def cache_get_entry(self, key):
+        with self.connection() as conn:
+            return conn.cache_get_entry(key)
+
+
+    def cache_get_entries(self, keys):
+        with self.connection() as conn:
+            return conn.cache_get_entries(keys)
+
+
+    def cache_set(self, key, value, ttl=0):
+        with self.connection() as conn:
+            return conn.cache_set(key, value, ttl)
+
+
+    def cache_set_many(self, items):
+        with self.connection() as conn:
+            return conn.cache_set_many(items)
+
+
+class MemoryStore(BaseStore):
+    """
+    Store kept in process memory. Cache holds up to `cache_max_size`
+    entries, least recently used are evicted first.
+    """
+
+    def __init__(self, cache_max_size=100000):
+        self._data = {}
+        # ttl 0 - never expires
+        self._cache = LRUCache(cache_max_size, default_ttl=float('inf'))
+        self._vocabulary = {} # name -> id
+        self._lock = threading.Lock()
 
-        ctime = int(time.mktime(datetime.datetime.utcnow().timetuple()))
-        if rec.ttl > 0 and ctime - rec.ctime >= rec.ttl:
+    def get(self, key):
+        return self._data.get(key)
+
+    def get_many(self, keys):
+        data = self._data
+        return dict((k, data[k]) for k in keys if k in data)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+        _written([key])
+
+    def set_many(self, items):
+        items = dict(items)
+        with self._lock:
+            self._data.update(items)
+        _written(items.keys())
+
+    def compare_and_set_many(self, items):
+        written = []
+        with self._lock:
+            for key, expected, value in items:
+                if key in self._data and self._data[key] == expected:
+                    self._data[key] = value
+                    written.append(key)
+        _written(written)
+        return written
+
+    def iter_data(self, batch_size=1000):
+        items = self._data.items()
+        for i in xrange(0, len(items), batch_size):
+            yield items[i:i + batch_size]
+
+    def get_vocabulary(self):
+        return dict((i, name) for name, i in self._vocabulary.items())
+
+    def add_vocabulary(self, names):
+        with self._lock:
+            for name in names:
+                if name not in self._vocabulary:
+                    self._vocabulary[name] = len(self._vocabulary) + 1
+            return dict((name, self._vocabulary[name]) for name in names)
+
+    def cache_get(self, key):
+        return self._cache.get(key)
+
+    def cache_get_entry(self, key):
+        entry = self._cache.get_entry(key)
+        if entry is None:
             return None
-        else:
-            return rec.value
 
+        value, left = entry
+        return value, (0 if left == float('inf') else left)
 
     def cache_set(self, key, value, ttl=0):
-        self._refresh_connection()
-        ctime = int(time.mktime(datetime.datetime.utcnow().timetuple()))
+        self._cache.set(key, value, ttl)
+
+
+class DiskStore(BaseStore):
+    """
+    Store in a local dbm file (via shelve), survives restarts.
+    Cache records keep their expiration time and are removed on read 
+    once expired.
+    """
+
+    DATA_PREFIX = 'd:'
+    CACHE_PREFIX = 'c:'
+    VOCABULARY_KEY = 'v'
+
+    def __init__(self, path):
+        self._db = shelve.open(path, protocol=2)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(prefix, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return prefix + key
+
+    def get(self, key):
+        with self._lock:
+            return self._db.get(self._key(self.DATA_PREFIX, key))
+
+    def set(self, key, value):
+        with self._lock:
+            self._db[self._key(self.DATA_PREFIX, key)] = value
+        _written([key])
+
+    def compare_and_set_many(self, items):
+        written = []
+        with self._lock:
+            for key, expected, value in items:
+                db_key = self._key(self.DATA_PREFIX, key)
+                if db_key in self._db and self._db[db_key] == expected:
+                    self._db[db_key] = value
+                    written.append(key)
+        _written(written)
+        return written
+
+    def iter_data(self, batch_size=1000):
+        prefix = self.DATA_PREFIX
+        with self._lock:
+            keys = [k for k in self._db.keys() if k.startswith(prefix)]
+        for i in xrange(0, len(keys), batch_size):
+            with self._lock:
+                page = [(k[len(prefix):], self._db.get(k)) for k in keys[i:i + batch_size]]
+            yield [(k, v) for k, v in page if v is not None]
+
+    def get_vocabulary(self):
+        with self._lock:
+            return dict(self._db.get(self.VOCABULARY_KEY, {}))
+
+    def add_vocabulary(self, names):
+        with self._lock:
+            vocabulary = self._db.get(self.VOCABULARY_KEY, {}) # id -> name
+            ids = dict((name, i) for i, name in vocabulary.iteritems())
+            for name in names:
+                if name not in ids:
+                    ids[name] = len(vocabulary) + 1
+                    vocabulary[ids[name]] = name
+            self._db[self.VOCABULARY_KEY] = vocabulary
+            return dict((name, ids[name]) for name in names)
+
+    def cache_get(self, key):
+        entry = self.cache_get_entry(key)
+        return None if entry is None else entry[0]
+
+    def cache_get_entry(self, key):
+        key = self._key(self.CACHE_PREFIX, key)
+        with self._lock:
+            rec = self._db.get(key)
+            if rec is None:
+                return None
+
+            value, expires = rec
+            if not expires:
+                return value, 0
+
+            left = expires - time.time()
+            if left <= 0:
+                del self._db[key]
+                return None
+            return value, left
+
+    def cache_set(self, key, value, ttl=0):
+        expires = time.time() + ttl if ttl > 0 else 0
+        with self._lock:
+            self._db[self._key(self.CACHE_PREFIX, key)] = (value, expires)
+
+    def sync(self):
+        with self._lock:
+            self._db.sync()
 
-        return self.cache_space.replace((key, value, ctime, ttl))
\ No newline at end of file
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -2,10 +2,34 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import errno
+import hashlib
+import httplib
+import json
+import logging
+import os
+import pstats
+import shutil
+import signal
+import tempfile
+import socket
+import threading
 import time
 import unittest
+from BaseHTTPServer import HTTPServer
+from StringIO import StringIO
 
+import tarantool
+
+import accesslog
 import api
+import batching
+import codec
+import load_interests
+import metrics
+import migrate_interests
+import tracing
+import scoring
 import store
 
 cases = {api.CharField:{"success":[1,None, ]}}
@@ -30,6 +54,13 @@ class TestFields(unittest.TestCase):
         with self.assertRaises(api.FieldValidationError):
             self.contaier.char_field = None
 
+    def test_values_per_instance(self):
+        other = self.contaier.__class__()
+        self.contaier.char_field = "first"
+        other.char_field = "second"
+        self.assertEqual(self.contaier.char_field, "first")
+        self.assertEqual(other.char_field, "second")
+
     def test_char_field(self):
         self.contaier.char_field = "str"
         self.assertEqual(self.contaier.char_field, "str")
@@ -106,6 +137,16 @@ class TestFields(unittest.TestCase):
         with self.assertRaises(api.FieldValidationError):
             self.contaier.date_field = "2100.01.01"
 
+    def test_parse_date(self):
+        for value in ["01.01.2017", "29.02.2016", "1.1.2017", "01.1.2017"]:
+            self.assertEqual(api.parse_date(value), datetime.datetime.strptime(value, "%d.%m.%Y"))
+            # second time from memo
+            self.assertEqual(api.parse_date(value), datetime.datetime.strptime(value, "%d.%m.%Y"))
+
+        for value in ["31.02.2017", "00.01.2017", "01.13.2017", "2019.01.01", "01.01.2017\n", "", "01.01.0000"]:
+            with self.assertRaises(ValueError):
+                api.parse_date(value)
+
     def test_gender_field(self):
         self.contaier.gender_field = 1
         self.assertEqual(self.contaier.gender_field, 1)
@@ -159,6 +200,469 @@ class TestRequest(unittest.TestCase):
     def test_score(self, request_data):
         response, code = api.method_handler({"body":request_data, "headers":self.headers}, {}, None)
 
+    def test_request_values_per_instance(self):
+        first = api.OnlineScoreRequest({"first_name": "a", "last_name": "b"})
+        second = api.OnlineScoreRequest({"phone": "79001112233", "email": "test@test.test"})
+
+        self.assertEqual(first.first_name, "a")
+        self.assertEqual(first.phone, None)
+        self.assertEqual(second.first_name, None)
+        self.assertEqual(second.phone, "79001112233")
+        self.assertFalse(hasattr(first, "__dict__"))
+
+    def test_auth_cache(self):
+        cache = api.AuthCache(max_size=10)
+        token = "6909573a28d6b12900257df0064967141fb2cd5e82b6c269f3aaf49a0b450749e75872e4a717b90687e7f65bac6c59c0865ecafc467da803a634d5d0079ee9f5"
+
+        self.assertTrue(cache.check("111", "test", token))
+        self.assertTrue(cache.check("111", "test", token))
+        self.assertFalse(cache.check("111", "test", "0"))
+        self.assertEqual(cache.stats()["hits"], 1)
+
+        admin_token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        self.assertTrue(cache.check("", api.ADMIN_LOGIN, admin_token))
+        self.assertFalse(cache.check("", api.ADMIN_LOGIN, token))
+
+    def test_context_has(self):
+        token = "6909573a28d6b12900257df0064967141fb2cd5e82b6c269f3aaf49a0b450749e75872e4a717b90687e7f65bac6c59c0865ecafc467da803a634d5d0079ee9f5"
+        arguments = {"phone": "79001112233", "email": "test@test.test", "first_name": "a", "last_name": None, "unknown": 1}
+        body = {"method": "online_score", "arguments": arguments, "account": "111", "login": "test", "token": token}
+        ctx = {}
+        response, code = api.method_handler({"body": body, "headers": self.headers}, ctx, store.MemoryStore())
+        self.assertEqual(code, api.OK)
+        self.assertEqual(ctx["has"], [k for k in arguments if k in ("phone", "email", "first_name")])
+
+    def test_response_cache(self):
+        token = "6909573a28d6b12900257df0064967141fb2cd5e82b6c269f3aaf49a0b450749e75872e4a717b90687e7f65bac6c59c0865ecafc467da803a634d5d0079ee9f5"
+        db = store.MemoryStore()
+        db.set("i:1", '["cars"]')
+        db.set("i:2", '["books"]')
+
+        def request(client_ids, token=token, date="19.07.2017"):
+            ctx = {}
+            body = {"method": "client_instrests", "arguments": {"client_ids": client_ids, "date": date},
+                    "account": "111", "login": "test", "token": token}
+            response, code = api.method_handler({"body": body, "headers": self.headers}, ctx, db)
+            return response, code, ctx
+
+        cache, api.response_cache = api.response_cache, api.ResponseCache(max_size=10)
+        try:
+            response, code, ctx = request([1, 2])
+            self.assertEqual(json.loads(codec.dumps(response)), {"1": ["cars"], "2": ["books"]})
+            self.assertNotIn("response_cached", ctx)
+
+            # same canonical arguments
+            cached, code, ctx = request([2, 1, 2])
+            self.assertEqual(cached, response)
+            self.assertEqual(ctx, {"nclients": 3, "response_cached": True})
+
+            # auth is still checked
+            _, code, _ = request([1, 2], token="0")
+            self.assertEqual(code, api.FORBIDDEN)
+
+            db.set("i:2", '["games"]')
+            self.assertEqual(len(api.response_cache), 0)
+            response, code, ctx = request([1, 2])
+            self.assertEqual(json.loads(codec.dumps(response)), {"1": ["cars"], "2": ["games"]})
+
+            # strftime can't format years before 1900
+            for _ in range(2):
+                response, code, ctx = request([1], date="01.01.1850")
+                self.assertEqual(code, api.OK)
+            self.assertEqual(ctx, {"nclients": 1, "response_cached": True})
+        finally:
+            api.response_cache = cache
+
+    def test_response_cache_bounds(self):
+        cache = api.ResponseCache(max_size=2, max_bytes=10, ttl=60)
+        cache.set("a", [1], codec.RawJSON("1234"), cache.generation)
+        cache.set("b", [2], codec.RawJSON("1234"), cache.generation)
+        cache.set("c", [3], codec.RawJSON("1234"), cache.generation)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get("c"), codec.RawJSON("1234"))
+        self.assertEqual(cache.stats()["bytes"], 8)
+
+        cache.set("d", [4], codec.RawJSON("12345678901"), cache.generation)
+        self.assertEqual(cache.get("d"), None)
+
+        # computed before a write - not stored
+        generation = cache.generation
+        cache.invalidate(["i:2"])
+        self.assertEqual(cache.get("b"), None)
+        cache.set("b", [2], codec.RawJSON("1234"), generation)
+        self.assertEqual(cache.get("b"), None)
+
+        self.assertEqual(api.ResponseCache.key("client_instrests", [1, 2, 2], None),
+                         api.ResponseCache.key("client_instrests", [2, 1], None))
+
+    def test_batch(self):
+        token = "6909573a28d6b12900257df0064967141fb2cd5e82b6c269f3aaf49a0b450749e75872e4a717b90687e7f65bac6c59c0865ecafc467da803a634d5d0079ee9f5"
+        batch = [
+            {"method": "online_score", "arguments": {"phone": "79001112233", "email": "test@test.test"}, "account": "111", "login": "test", "token": token},
+            {"method": "online_score", "arguments": {"first_name": "a", "last_name": "b"}, "account": "111", "login": "test", "token": "0"},
+            {"method": "online_score", "arguments": {}, "account": "111", "login": "test", "token": token},
+            "not a request",
+            # fail outside of validation - no account, null arguments
+            {"method": "online_score", "arguments": {"phone": "79001112233", "email": "test@test.test"}, "login": "test", "token": token},
+            {"method": "online_score", "arguments": None, "account": "111", "login": "test", "token": token},
+        ]
+        ctx = {}
+        logging.disable(logging.ERROR)
+        try:
+            response, code = api.batch_handler({"body": batch, "headers": self.headers}, ctx, None)
+        finally:
+            logging.disable(logging.NOTSET)
+
+        self.assertEqual(code, api.OK)
+        self.assertEqual([r["code"] for r in response], [api.OK, api.FORBIDDEN, api.INVALID_REQUEST, api.INVALID_REQUEST,
+                                                         api.INTERNAL_ERROR, api.INTERNAL_ERROR])
+        self.assertEqual(response[0]["response"], {"score": 3.0})
+        self.assertEqual(ctx["nitems"], 6)
+
+    def test_batch_not_list(self):
+        _, code = api.batch_handler({"body": {}, "headers": self.headers}, {}, None)
+        self.assertEqual(code, api.INVALID_REQUEST)
+
+    def test_compiled_schema(self):
+        self.assertEqual(list(api.MethodRequest.fields), ["account", "login", "token", "arguments", "method"])
+        self.assertEqual(api.MethodRequest._required, ("login", "token", "arguments", "method"))
+        self.assertEqual(api.ClientsInterestsRequest._required, ("client_ids",))
+
+    def test_missing_required_field(self):
+        with self.assertRaises(api.ValidationError) as cm:
+            api.ClientsInterestsRequest({"date": "01.01.2017"})
+        self.assertEqual(cm.exception.field, "client_ids")
+
+
+class TestRequestBody(unittest.TestCase):
+
+    class Handler(api.MainHTTPHandler):
+        max_body_size = 16
+
+        def __init__(self, body, headers):
+            self.rfile = StringIO(body)
+            self.headers = headers
+
+    def test_content_length(self):
+        handler = self.Handler('{"a": 1}', {"Content-Length": "8"})
+        self.assertEqual(handler.read_body(), '{"a": 1}')
+
+    def test_too_large(self):
+        handler = self.Handler('{"a": "' + "x" * 100 + '"}', {"Content-Length": "110"})
+        with self.assertRaises(api.RequestBodyError) as cm:
+            handler.read_body()
+        self.assertEqual(cm.exception.code, api.REQUEST_TOO_LARGE)
+        self.assertEqual(handler.rfile.tell(), 0)
+
+    def test_bad_content_length(self):
+        for headers in [{}, {"Content-Length": "x"}, {"Content-Length": "-1"}, {"Content-Length": "10"}]:
+            with self.assertRaises(api.RequestBodyError) as cm:
+                self.Handler('{}', headers).read_body()
+            self.assertEqual(cm.exception.code, api.BAD_REQUEST)
+
+    def test_chunked(self):
+        handler = self.Handler('3\r\n{"a\r\n5;ext=1\r\n": 1}\r\n0\r\n\r\n', {"Transfer-Encoding": "chunked"})
+        self.assertEqual(handler.read_body(), '{"a": 1}')
+
+        handler = self.Handler('-1\r\n' + "x" * 100, {"Transfer-Encoding": "chunked"})
+        with self.assertRaises(api.RequestBodyError) as cm:
+            handler.read_body()
+        self.assertEqual(cm.exception.code, api.BAD_REQUEST)
+        self.assertEqual(handler.rfile.tell(), 4)
+
+    def test_chunked_too_large(self):
+        handler = self.Handler('a\r\n0123456789\r\na\r\n0123456789\r\n0\r\n\r\n', {"Transfer-Encoding": "chunked"})
+        with self.assertRaises(api.RequestBodyError) as cm:
+            handler.read_body()
+        self.assertEqual(cm.exception.code, api.REQUEST_TOO_LARGE)
+
+
+class TestHTTPServer(unittest.TestCase):
+
+    request = json.dumps({"method": "online_score", "arguments": {"phone": "79001112233", "email": "test@test.test"}, "account": "111", "login": "test", "token": "6909573a28d6b12900257df0064967141fb2cd5e82b6c269f3aaf49a0b450749e75872e4a717b90687e7f65bac6c59c0865ecafc467da803a634d5d0079ee9f5"})
+
+    def setUp(self):
+        # serve without store
+        self.api_store, api.store = api.store, None
+        api.MainHTTPHandler.log_message = lambda *args: None
+        self.server = api.KeepAliveHTTPServer(("localhost", 0), api.MainHTTPHandler)
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        del api.MainHTTPHandler.log_message
+        api.store = self.api_store
+
+    def test_keepalive(self):
+        conn = httplib.HTTPConnection("localhost", self.port)
+        for _ in range(3):
+            conn.request("POST", "/method", self.request)
+            sock = conn.sock
+            response = conn.getresponse()
+            body = response.read()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(int(response.getheader("Content-Length")), len(body))
+            self.assertEqual(json.loads(body)["response"], {"score": 3.0})
+            # connection is reused
+            self.assertIs(conn.sock, sock)
+        conn.close()
+
+    def test_pipelining(self):
+        request = "POST /method HTTP/1.1\r\nHost: localhost\r\nContent-Length: %s\r\n\r\n%s" % (len(self.request), self.request)
+        sock = socket.create_connection(("localhost", self.port))
+        sock.sendall(request * 2)
+        responses = []
+        for _ in range(2):
+            response = httplib.HTTPResponse(sock)
+            response.begin()
+            responses.append((response.status, json.loads(response.read())))
+        sock.close()
+
+        self.assertEqual(responses, [(200, {"code": 200, "response": {"score": 3.0}})] * 2)
+
+    def test_metrics(self):
+        conn = httplib.HTTPConnection("localhost", self.port)
+        conn.request("POST", "/method", self.request)
+        conn.getresponse().read()
+        conn.request("GET", "/metrics")
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+
+        self.assertEqual(response.status, 200)
+        self.assertIn('http_requests_total{code="200",method="online_score",path="method"}', body)
+        self.assertIn("auth_seconds_count", body)
+
+    def test_max_keepalive_requests(self):
+        max_requests, api.MainHTTPHandler.max_keepalive_requests = api.MainHTTPHandler.max_keepalive_requests, 1
+        try:
+            conn = httplib.HTTPConnection("localhost", self.port)
+            conn.request("POST", "/method", self.request)
+            response = conn.getresponse()
+            response.read()
+            self.assertEqual(response.getheader("Connection"), "close")
+        finally:
+            api.MainHTTPHandler.max_keepalive_requests = max_requests
+
+
+class TestThreadPoolHTTPServer(unittest.TestCase):
+
+    request = TestHTTPServer.request
+
+    def setUp(self):
+        self.api_store, api.store = api.store, None
+        api.MainHTTPHandler.log_message = lambda *args: None
+
+    def tearDown(self):
+        del api.MainHTTPHandler.log_message
+        api.store = self.api_store
+
+    def serve(self, server):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1]
+
+    def post(self, conn):
+        conn.request("POST", "/method", self.request)
+        response = conn.getresponse()
+        response.read()
+        return response
+
+    def test_concurrent_requests(self):
+        server = api.ThreadPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, workers=2)
+        port = server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        results = []
+        def request():
+            conn = httplib.HTTPConnection("localhost", port, timeout=5)
+            conn.request("POST", "/method", self.request)
+            response = conn.getresponse()
+            results.append((response.status, json.loads(response.read())["response"]))
+            conn.close()
+
+        try:
+            clients = [threading.Thread(target=request) for _ in range(8)]
+            for t in clients:
+                t.start()
+            for t in clients:
+                t.join()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(results, [(200, {"score": 3.0})] * 8)
+
+    def test_no_keepalive_in_single_mode(self):
+        port = self.serve(HTTPServer(("localhost", 0), api.MainHTTPHandler))
+        conn = httplib.HTTPConnection("localhost", port, timeout=5)
+        response = self.post(conn)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.getheader("Connection"), "close")
+        conn.close()
+
+    def assert_not_blocked_by_idle(self, port, idle):
+        # idle keep-alive connections, more than there are workers - 
+        # none of the requests may wait for keepalive timeout
+        started = time.time()
+        connections = []
+        for _ in range(idle + 1):
+            conn = httplib.HTTPConnection("localhost", port, timeout=5)
+            self.assertEqual(self.post(conn).status, 200)
+            connections.append(conn)
+        self.assertTrue(time.time() - started < 2)
+
+        for conn in connections:
+            conn.close()
+
+    def test_idle_connections_threaded(self):
+        server = api.ThreadPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, workers=2)
+        self.assert_not_blocked_by_idle(self.serve(server), idle=3)
+
+    def test_idle_connections_prefork(self):
+        # a prefork worker is one process serving one connection at a time
+        server = api.KeepAliveHTTPServer(("localhost", 0), api.MainHTTPHandler)
+        self.assert_not_blocked_by_idle(self.serve(server), idle=2)
+
+    def test_server_close(self):
+        server = api.ThreadPoolHTTPServer(("localhost", 0), api.MainHTTPHandler, workers=1)
+        pairs = []
+        for _ in range(3):
+            theirs = socket.create_connection(server.server_address)
+            ours, _ = server.socket.accept()
+            pairs.append((ours, theirs))
+        try:
+            # the worker waits for a request on the first connection,
+            # the others fill the queue
+            for ours, _ in pairs:
+                server.process_request(ours, ("localhost", 0))
+
+            closing = threading.Thread(target=server.server_close)
+            closing.daemon = True
+            closing.start()
+            closing.join(2)
+            self.assertFalse(closing.is_alive())
+        finally:
+            for _, theirs in pairs:
+                theirs.close()
+
+
+class TestServePrefork(unittest.TestCase):
+
+    class Server(object):
+        def serve_forever(self):
+            pass
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_worker_numbers(self):
+        def init_worker(worker):
+            open(os.path.join(self.path, str(worker)), "w").close()
+
+        for _ in range(2):
+            api.serve_prefork(self.Server(), 3, init_worker)
+            # restarted workers get the same numbers
+            self.assertEqual(sorted(os.listdir(self.path)), ["0", "1", "2"])
+
+    def test_disk_store_path(self):
+        class Options(object):
+            fallback_store = "disk"
+            fallback_store_path = os.path.join(self.path, "store")
+
+        db = api.open_fallback_store(Options(), worker=1)
+        db.set("key", "value")
+        db.close()
+        db = api.open_fallback_store(Options(), worker=1)
+        self.assertEqual(db.get("key"), "value")
+        db.close()
+        self.assertTrue(any(name.startswith("store.1") for name in os.listdir(self.path)))
+
+    def serve(self):
+        """Runs serve_prefork with one worker in a child process, returns (its pid, worker pid, port)"""
+        server = api.KeepAliveHTTPServer(("localhost", 0), api.MainHTTPHandler)
+
+        def init_worker(worker):
+            api.store = None
+            api.MainHTTPHandler.log_message = lambda *args: None
+            with open(os.path.join(self.path, "worker"), "w") as f:
+                f.write(str(os.getpid()))
+
+        def finish_worker():
+            open(os.path.join(self.path, "finished"), "w").close()
+
+        pid = os.fork()
+        if pid == 0:
+            try:
+                api.serve_prefork(server, 1, init_worker, finish_worker)
+            finally:
+                os._exit(0)
+        server.server_close()
+
+        deadline = time.time() + 2
+        while not os.path.exists(os.path.join(self.path, "worker")) and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        with open(os.path.join(self.path, "worker")) as f:
+            return pid, int(f.read()), server.server_address[1]
+
+    def wait_exit(self, pid, timeout=2):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_worker_stop(self):
+        pid, worker, port = self.serve()
+        try:
+            conn = httplib.HTTPConnection("localhost", port)
+            conn.request("POST", "/method", TestHTTPServer.request)
+            conn.getresponse().read()
+
+            # the worker waits for the next request on the connection
+            os.kill(worker, signal.SIGTERM)
+            self.assertTrue(self.wait_exit(pid))
+            self.assertTrue(os.path.exists(os.path.join(self.path, "finished")))
+            conn.close()
+        finally:
+            self.kill(pid, worker)
+
+    def test_stop(self):
+        pid, worker, port = self.serve()
+        try:
+            os.kill(pid, signal.SIGTERM)
+            self.assertTrue(self.wait_exit(pid))
+            # workers were stopped and waited for
+            self.assertTrue(os.path.exists(os.path.join(self.path, "finished")))
+            self.assertRaises(OSError, os.kill, worker, 0)
+        finally:
+            self.kill(pid, worker)
+
+    def kill(self, pid, worker):
+        for p in (worker, pid):
+            try:
+                os.kill(p, signal.SIGKILL)
+            except OSError:
+                pass
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
 
 class TestSuite(unittest.TestCase):
     def setUp(self):
@@ -254,6 +758,24 @@ class TestStore(unittest.TestCase):
         value = self.db.get("test1")
         self.assertEqual(value, test_value)
 
+    def test_store_get_many(self):
+        self.db.set("test1", "val1")
+        self.db.set("test2", "val2")
+
+        values = self.db.get_many(["test1", "test2", "test_missing"])
+        self.assertEqual(values, {"test1": "val1", "test2": "val2"})
+        self.assertEqual(self.db.get_many([]), {})
+
+    def test_store_set_many(self):
+        self.db.set_many([("test1", "val1"), ("test2", "val2")])
+        self.assertEqual(self.db.get_many(["test1", "test2"]), {"test1": "val1", "test2": "val2"})
+        self.assertIn(("test1", "val1"), sum(self.db.iter_data(batch_size=1), []))
+
+    def test_store_vocabulary(self):
+        ids = self.db.add_vocabulary([u"test_cars", u"test_pets"])
+        self.assertEqual(self.db.add_vocabulary([u"test_cars"]), {u"test_cars": ids[u"test_cars"]})
+        self.assertEqual(self.db.get_vocabulary()[ids[u"test_pets"]], u"test_pets")
+
     def test_store_cache_write_read(self):
         test_value = "test_val"
         self.db.cache_set("test1", test_value)
@@ -272,6 +794,659 @@ class TestStore(unittest.TestCase):
 
         self.assertEqual(val, None)
 
+    def test_store_cache_expire(self):
+        self.db.cache_set('test_ttl', 'test_ttl_val', 1)
+        time.sleep(2)
+        expired, evicted = self.db.cache_expire()
+
+        self.assertTrue(expired >= 1)
+        self.assertEqual(len(self.db.db.select('cache', 'test_ttl')), 0)
+
+    def test_store_cache_max_size(self):
+        for i in range(3):
+            self.db.cache_set('test_size%s' % i, i)
+        self.db.cache_expire(max_size=1)
+
+        self.assertEqual(len(self.db.db.select('cache')), 1)
+
+
+class TestStoreReconnect(unittest.TestCase):
+
+    class Connection(object):
+        """tarantool.Connection stub failing the first `failures` operations"""
+
+        def __init__(self, test):
+            self.test = test
+            self.closed = False
+            test.connections.append(self)
+
+        def _fail(self):
+            if self.test.failures:
+                self.test.failures -= 1
+                raise tarantool.error.NetworkError(socket.error(errno.ECONNRESET, "reset"))
+
+        def space(self, name):
+            pass
+
+        def eval(self, *args):
+            pass
+
+        def select(self, space, key):
+            self._fail()
+            response = [(key, "value")]
+            return type("Response", (list,), {"data": response})(response)
+
+        def ping(self):
+            self._fail()
+
+        def close(self):
+            self.closed = True
+
+    def setUp(self):
+        self.connections = []
+        self.failures = 0
+        self.tarantool_connection = tarantool.Connection
+        tarantool.Connection = lambda *args, **kwargs: self.Connection(self)
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        tarantool.Connection = self.tarantool_connection
+        logging.disable(logging.NOTSET)
+
+    def test_retry(self):
+        db = store.StoreTarantool(retry_attempts=1)
+        self.failures = 1
+        self.assertEqual(db.get("key"), "value")
+        # the broken connection was dropped and replaced
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.connections[0].closed)
+
+    def test_retries_exhausted(self):
+        db = store.StoreTarantool(retry_attempts=2)
+        self.failures = 3
+        with self.assertRaises(store.StoreError):
+            db.get("key")
+        self.assertEqual(len(self.connections), 3)
+        self.assertEqual(db.db, None)
+
+        # the next operation reconnects
+        self.assertEqual(db.get("key"), "value")
+
+    def test_keepalive(self):
+        db = store.StoreTarantool(retry_attempts=0, keepalive_interval=0.01)
+        self.failures = 1
+        deadline = time.time() + 1
+        while len(self.connections) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        # the failed ping dropped the connection, the next ones reconnected
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.connections[0].closed)
+        self.assertEqual(db.get("key"), "value")
+        db.close()
+
+
+class TestScoring(unittest.TestCase):
+
+    def test_score_key(self):
+        birthday = datetime.datetime(1988, 1, 1)
+        key = scoring.get_score_key("79001112233", "test@test.test", birthday, 1, "first", "last")
+
+        self.assertEqual(key, scoring.get_score_key(79001112233, "test@test.test", birthday, 1, "first", "last"))
+        self.assertNotEqual(key, scoring.get_score_key("79001112234", "test@test.test", birthday, 1, "first", "last"))
+        self.assertNotEqual(key, scoring.get_score_key("79001112233", "test@test.test", birthday, 2, "first", "last"))
+        self.assertNotEqual(key, scoring.get_score_key("79001112233", "other@test.test", birthday, 1, "first", "last"))
+        self.assertNotEqual(scoring.get_score_key(None, None, first_name="ab", last_name="c"), 
+                            scoring.get_score_key(None, None, first_name="a", last_name="bc"))
+
+    def test_score_without_store(self):
+        self.assertEqual(scoring.get_score(None, "79001112233", "test@test.test"), 3.0)
+        self.assertEqual(scoring.get_score(None, None, None, first_name=u"имя", last_name=u"фамилия"), 0.5)
+
+    def test_interests_many_invalid(self):
+        db = store.MemoryStore()
+        db.set_many([("i:1", '["cars"]'), ("i:2", "broken"), ("i:3", '{"cars": 1}'), ("i:4", "[1, ")])
+        logging.disable(logging.ERROR)
+        try:
+            raw = scoring.get_interests_many(db, [1, 2, 3, 4], raw=True)
+            decoded = scoring.get_interests_many(db, [1, 2, 3, 4])
+        finally:
+            logging.disable(logging.NOTSET)
+
+        expected = {1: ["cars"], 2: [], 3: [], 4: []}
+        self.assertEqual(decoded, expected)
+        self.assertEqual(json.loads(codec.dumps(raw)), dict((str(k), v) for k, v in expected.items()))
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_raw_fragments(self):
+        data = {"response": {1: codec.RawJSON('["car", "boat"]'), 2: codec.RawJSON('[]')}, "code": 200}
+        expected = {"response": {"1": ["car", "boat"], "2": []}, "code": 200}
+
+        self.assertEqual(codec.loads(codec.dumps(data)), expected)
+
+        # encoding used with stdlib json
+        chunks = []
+        codec._encode(data, chunks)
+        self.assertEqual(codec.loads("".join(chunks)), expected)
+
+
+class TestAccessLog(unittest.TestCase):
+
+    class Handler(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.messages = []
+            self.unblocked = threading.Event()
+            self.unblocked.set()
+
+        def emit(self, record):
+            self.unblocked.wait()
+            self.messages.append(record.getMessage())
+
+    def setUp(self):
+        self.handler = self.Handler()
+        self.logger = logging.getLogger("test_access_log")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+
+    def test_log(self):
+        log = accesslog.AccessLog(self.logger, max_body_size=4, body_sample_rate=0)
+        log.log("%s-%s", 1, 2)
+        log.log_request("/method", "0123456789", "id")
+        log.close()
+
+        self.assertEqual(self.handler.messages, ["1-2", "/method: 0123... (10 bytes) id"])
+
+    def test_drop_on_overflow(self):
+        self.handler.unblocked.clear()
+        log = accesslog.AccessLog(self.logger, max_queue=1)
+        for i in range(10):
+            log.log("%s", i)
+        self.assertTrue(log.stats()["dropped"] > 0)
+
+        self.handler.unblocked.set()
+        log.close()
+        self.assertEqual(len(self.handler.messages), 10 - log.dropped)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        registry = metrics.Registry()
+        registry.counter("requests_total", "Requests", code=200).inc()
+        registry.counter("requests_total", "Requests", code=200).inc()
+        histogram = registry.histogram("latency_seconds", buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        registry.gauge("size", lambda: 3)
+
+        lines = registry.render().splitlines()
+        self.assertIn('# HELP requests_total Requests', lines)
+        self.assertIn('requests_total{code="200"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('latency_seconds_count 3', lines)
+        self.assertIn('size 3', lines)
+
+
+class TestTracing(unittest.TestCase):
+
+    def test_spans(self):
+        @tracing.traced("inner")
+        def inner():
+            return 1
+
+        with tracing.span("outside"):
+            pass
+
+        with tracing.request_scope("request-1") as trace:
+            with tracing.span("outer"):
+                self.assertEqual(inner(), 1)
+
+        self.assertEqual(trace.request_id, "request-1")
+        self.assertEqual([name for name, _ in trace.as_list()], ["inner", "outer"])
+        self.assertEqual(tracing.current_trace(), None)
+
+    def test_profiler(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            profiler = tracing.Profiler(rate=1, dump_path=path, dump_interval=0)
+            with profiler.sample():
+                sorted(range(1000))
+
+            stats = pstats.Stats(path)
+            self.assertTrue(stats.total_calls > 0)
+        finally:
+            os.remove(path)
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = store.LRUCache(max_size=2, default_ttl=60)
+
+    def test_cache_hit_miss(self):
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("b"), None)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_cache_eviction(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+
+        self.assertEqual(self.cache.get("b"), None)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("c"), 3)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_cache_ttl(self):
+        self.cache.set("a", 1, ttl=0.01)
+        time.sleep(0.02)
+        self.assertEqual(self.cache.get("a"), None)
+
+
+class TestL1CacheStore(unittest.TestCase):
+
+    def setUp(self):
+        self.backing = store.MemoryStore()
+        self.db = store.L1CacheStore(self.backing, max_size=10, max_ttl=0.05)
+
+    def test_write_through(self):
+        self.db.cache_set("key", "value", 60)
+        self.assertEqual(self.backing.cache_get("key"), "value")
+        self.assertEqual(self.db.l1.get("key"), "value")
+
+    def test_read_fill(self):
+        self.backing.cache_set("key", "value")
+        self.assertEqual(self.db.cache_get("key"), "value")
+        self.assertEqual(self.db.cache_get_many(["key", "missing"]), {"key": "value"})
+
+        # served from L1 until max_ttl
+        self.backing.cache_set("key", "new")
+        self.assertEqual(self.db.cache_get("key"), "value")
+        stats = self.db.stats()
+        self.assertEqual((stats["hits"], stats["size"]), (2, 1))
+
+    def test_ttl_cap(self):
+        self.db.cache_set("key", "value", 60)
+        self.backing.cache_set("key", "new", 60)
+        time.sleep(0.06)
+        self.assertEqual(self.db.cache_get("key"), "new")
+
+    def test_backing_ttl(self):
+        db = store.L1CacheStore(self.backing, max_size=10, max_ttl=60)
+        # cached by another process with a short ttl
+        self.backing.cache_set("key", "value", 0.05)
+        self.backing.cache_set("other", "value", 0.05)
+        self.assertEqual(db.cache_get("key"), "value")
+        self.assertEqual(db.cache_get_many(["other"]), {"other": "value"})
+
+        time.sleep(0.06)
+        self.assertEqual(db.cache_get("key"), None)
+        self.assertEqual(db.cache_get_many(["other"]), {})
+
+
+class StoreTests(object):
+    """Store interface tests, mixed into a TestCase that sets self.db"""
+
+    def test_write_read(self):
+        self.db.set("test1", "test_val")
+        self.assertEqual(self.db.get("test1"), "test_val")
+        self.assertEqual(self.db.get("test_missing"), None)
+
+    def test_many(self):
+        self.db.set_many([("test1", "val1"), ("test2", "val2")])
+        self.assertEqual(self.db.get_many(["test1", "test2", "test_missing"]), {"test1": "val1", "test2": "val2"})
+
+    def test_cache_write_read(self):
+        self.db.cache_set("test1", 1.5)
+        self.assertEqual(self.db.cache_get("test1"), 1.5)
+        self.assertEqual(self.db.cache_get("test_missing"), None)
+
+    def test_vocabulary(self):
+        ids = self.db.add_vocabulary([u"cars", u"книги"])
+        self.assertEqual(self.db.add_vocabulary([u"pets", u"cars"]), {u"pets": ids[u"книги"] + 1, u"cars": ids[u"cars"]})
+        vocabulary = self.db.get_vocabulary()
+        self.assertEqual(vocabulary[ids[u"книги"]], u"книги")
+        self.assertEqual(len(vocabulary), 3)
+
+    def test_iter_data(self):
+        self.db.set_many([("test%s" % i, "val%s" % i) for i in range(5)])
+        pages = list(self.db.iter_data(batch_size=2))
+        self.assertEqual(max(len(page) for page in pages), 2)
+        self.assertEqual(dict(sum(pages, [])), dict(("test%s" % i, "val%s" % i) for i in range(5)))
+
+    def test_compare_and_set_many(self):
+        self.db.set_many([("test1", "val1"), ("test2", "val2")])
+        written = self.db.compare_and_set_many([("test1", "val1", "new1"), ("test2", "other", "new2"),
+                                                ("test_missing", "val", "new")])
+        self.assertEqual(written, ["test1"])
+        self.assertEqual(self.db.get_many(["test1", "test2", "test_missing"]), {"test1": "new1", "test2": "val2"})
+
+    def test_cache_many(self):
+        self.db.cache_set_many([("test1", 1.5, 0), ("test2", 2.5, 60)])
+        self.assertEqual(self.db.cache_get_many(["test1", "test2", "test_missing"]), {"test1": 1.5, "test2": 2.5})
+
+    def test_cache_entry(self):
+        self.db.cache_set("test1", "val1", 60)
+        self.db.cache_set("test2", "val2")
+        value, ttl = self.db.cache_get_entry("test1")
+        self.assertEqual(value, "val1")
+        self.assertTrue(0 < ttl <= 60)
+        self.assertEqual(self.db.cache_get_entries(["test2", "test_missing"]), {"test2": ("val2", 0)})
+
+    def test_cache_ttl(self):
+        self.db.cache_set("test_ttl", "test_ttl_val", 0.01)
+        time.sleep(0.02)
+        self.assertEqual(self.db.cache_get("test_ttl"), None)
+
+
+class TestMemoryStore(StoreTests, unittest.TestCase):
+    def setUp(self):
+        self.db = store.MemoryStore()
+
+
+class TestDiskStore(StoreTests, unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = store.DiskStore(os.path.join(self.path, "store"))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.path)
+
+    def test_persistence(self):
+        self.db.set(u"тест", "test_val")
+        self.db.close()
+        self.db = store.DiskStore(os.path.join(self.path, "store"))
+        self.assertEqual(self.db.get(u"тест"), "test_val")
+
+
+class TestStoreWrappers(unittest.TestCase):
+
+    def setUp(self):
+        self.backing = store.MemoryStore()
+        self.wrappers = [store.L1CacheStore(self.backing), store.WriteBehindStore(self.backing),
+                         batching.BatchLoader(self.backing)]
+
+    def tearDown(self):
+        for db in self.wrappers:
+            db.close()
+
+    def test_forwarded(self):
+        self.backing.set("i:1", "[]")
+        ids = self.backing.add_vocabulary([u"cars"])
+        for db in self.wrappers:
+            self.assertEqual(db.get_vocabulary(), {ids[u"cars"]: u"cars"})
+            self.assertEqual(db.add_vocabulary([u"cars"]), ids)
+            self.assertEqual(list(db.iter_data()), [[("i:1", "[]")]])
+
+    def test_missing_method(self):
+        class Wrapper(store.BaseStore):
+            get = set = cache_get = cache_set = get_vocabulary = add_vocabulary = None
+
+        with self.assertRaises(TypeError):
+            Wrapper()
+
+
+class TestWriteBehindStore(unittest.TestCase):
+
+    class SlowStore(store.MemoryStore):
+        def __init__(self):
+            store.MemoryStore.__init__(self)
+            self.batches = []
+            self.unblocked = threading.Event()
+            self.unblocked.set()
+
+        def cache_set_many(self, items):
+            self.unblocked.wait()
+            self.batches.append(list(items))
+            store.MemoryStore.cache_set_many(self, items)
+
+    def setUp(self):
+        self.store = self.SlowStore()
+        self.db = store.WriteBehindStore(self.store, max_queue=3, batch_size=10, flush_interval=0.01)
+
+    def tearDown(self):
+        self.store.unblocked.set()
+        self.db.close()
+
+    def test_flush_on_close(self):
+        for i in range(3):
+            self.db.cache_set("key%s" % i, i)
+        self.db.close()
+        self.assertEqual(self.store.cache_get_many(["key0", "key1", "key2"]), {"key0": 0, "key1": 1, "key2": 2})
+        self.assertEqual(self.db.stats()["flushed"], 3)
+        self.assertRaises(store.StoreError, self.db.cache_set, "key3", 3)
+
+    def test_queued_reads(self):
+        self.store.unblocked.clear()
+        self.db.cache_set("key1", 1)
+        self.assertEqual(self.db.cache_get("key1"), 1)
+        self.assertEqual(self.db.cache_get_many(["key1", "missing"]), {"key1": 1})
+        self.assertEqual(self.store.cache_get("key1"), None)
+
+    def test_coalesce_and_drop(self):
+        self.store.unblocked.clear()
+        self.db.cache_set("key0", 0)
+        # wait for the writer to take the first batch
+        while self.db.stats()["queued"]:
+            time.sleep(0.001)
+
+        for i in range(5):
+            self.db.cache_set("key%s" % i, i)
+        self.db.cache_set("key1", "new")
+
+        stats = self.db.stats()
+        self.assertEqual(stats["queued"], 3)
+        self.assertEqual(stats["dropped"], 2)
+        self.assertEqual(stats["coalesced"], 1)
+
+        self.store.unblocked.set()
+        self.db.close()
+        self.assertEqual(self.store.batches[1], [("key0", 0, 0), ("key1", "new", 0), ("key2", 2, 0)])
+        self.assertEqual(self.store.cache_get("key4"), None)
+
+    def test_flush_error(self):
+        def fail(items):
+            raise store.StoreError("fail")
+        self.store.cache_set_many = fail
+        self.db.cache_set("key1", 1)
+        self.db.close()
+        self.assertEqual(self.db.stats()["failed"], 1)
+
+
+class TestBatchLoader(unittest.TestCase):
+
+    class CountingStore(store.MemoryStore):
+        def __init__(self):
+            store.MemoryStore.__init__(self)
+            self.fetches = []
+
+        def get_many(self, keys):
+            self.fetches.append(sorted(keys))
+            return store.MemoryStore.get_many(self, keys)
+
+    def setUp(self):
+        self.store = self.CountingStore()
+        self.store.set_many(("i:%s" % i, str(i)) for i in range(10))
+        self.loader = batching.BatchLoader(self.store, window=0.05, max_keys=100)
+
+    def test_batching(self):
+        results = []
+        def lookup(i):
+            results.append(self.loader.get_many(["i:%s" % i, "i:%s" % (i + 1), "i:missing"]))
+
+        threads = [threading.Thread(target=lookup, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(results), 8)
+        for result in results:
+            self.assertEqual(len(result), 2)
+        # deduplicated keys in fewer fetches than callers
+        self.assertTrue(len(self.store.fetches) < 8)
+        fetched = sum(self.store.fetches, [])
+        self.assertEqual(len(fetched), len(set(fetched)))
+
+    def test_single_key(self):
+        self.assertEqual(self.loader.get("i:1"), "1")
+        self.assertEqual(self.loader.get("i:missing"), None)
+        self.assertEqual(self.loader.get_many([]), {})
+
+    def test_max_keys(self):
+        loader = batching.BatchLoader(self.store, window=10, max_keys=2)
+        started = time.time()
+        self.assertEqual(loader.get_many(["i:1", "i:2"]), {"i:1": "1", "i:2": "2"})
+        self.assertTrue(time.time() - started < 1)
+
+    def test_error(self):
+        def fail(keys):
+            raise store.StoreError("fail")
+        self.store.get_many = fail
+        loader = batching.BatchLoader(self.store, window=0.01)
+        with self.assertRaises(store.StoreError):
+            loader.get("i:1")
+
+
+class TestInterestsEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.db = store.MemoryStore()
+
+    def test_encode_decode(self):
+        ids = scoring.encode_interests(self.db, [u"cars", u"pets", u"cars"])
+        self.assertEqual(len(set(ids)), 2)
+        self.assertEqual(scoring.decode_interests(self.db, ids), [u"cars", u"pets", u"cars"])
+        self.assertEqual(scoring.decode_interests(self.db, '["books"]'), [u"books"])
+        self.assertEqual(scoring.decode_interests(self.db, None), [])
+
+    def test_new_names_from_other_process(self):
+        scoring.decode_interests(self.db, scoring.encode_interests(self.db, [u"cars"]))
+        # added bypassing this process' vocabulary
+        ids = self.db.add_vocabulary([u"boats"])
+        self.assertEqual(scoring.decode_interests(self.db, [ids[u"boats"]]), [u"boats"])
+        self.assertEqual(scoring.decode_interests(self.db, [ids[u"boats"] + 100]), [])
+
+    def test_interests_many(self):
+        self.db.set("i:1", scoring.encode_interests(self.db, [u"cars"]))
+        self.db.set("i:2", '["pets"]')
+        interests = scoring.get_interests_many(self.db, [1, 2, 3], raw=True)
+        self.assertEqual(json.loads(codec.dumps(interests)), {"1": ["cars"], "2": ["pets"], "3": []})
+        self.assertEqual(scoring.get_interests(self.db, 1), [u"cars"])
+
+    def test_migrate(self):
+        self.db.set_many([("i:%s" % cid, codec.dumps(["interest%s" % (cid % 3)])) for cid in range(100)])
+        self.db.set("i:100", "broken")
+        self.db.set("other", "[]")
+
+        # read by the server as no interests
+        for cid, value in [(101, '{"cars": 1}'), (102, '"boat"'), (103, '5'), (104, '[5]')]:
+            self.db.set("i:%s" % cid, value)
+
+        stats = migrate_interests.migrate(self.db, batch_size=16, workers=2, dry_run=True)
+        self.assertEqual((stats.scanned, stats.migrated, stats.invalid), (106, 100, 5))
+        self.assertEqual(self.db.get_vocabulary(), {})
+        self.assertEqual(self.db.get("i:5"), '["interest2"]')
+
+        stats = migrate_interests.migrate(self.db, batch_size=16, workers=2)
+        self.assertEqual((stats.scanned, stats.migrated, stats.invalid), (106, 100, 5))
+        self.assertEqual(self.db.get("i:101"), '{"cars": 1}')
+        self.assertEqual(len(self.db.get_vocabulary()), 3)
+        self.assertEqual(self.db.get("i:5"), scoring.encode_interests(self.db, [u"interest2"]))
+        self.assertEqual(scoring.get_interests(self.db, 5), [u"interest2"])
+
+        # nothing left to migrate
+        self.assertEqual(migrate_interests.migrate(self.db).migrated, 0)
+
+    def test_migrate_concurrent_write(self):
+        self.db.set_many([("i:1", '["cars"]'), ("i:2", '["pets"]')])
+        compare_and_set_many = self.db.compare_and_set_many
+
+        def write(items):
+            # the server writes between the scan and the migration
+            self.db.set("i:1", scoring.encode_interests(self.db, [u"boats"]))
+            return compare_and_set_many(items)
+        self.db.compare_and_set_many = write
+
+        stats = migrate_interests.migrate(self.db, workers=1)
+        self.assertEqual((stats.migrated, stats.changed), (1, 1))
+        self.assertEqual(scoring.get_interests(self.db, 1), [u"boats"])
+        self.assertEqual(scoring.get_interests(self.db, 2), [u"pets"])
+
+
+class TestLoadInterests(unittest.TestCase):
+
+    def test_readers(self):
+        lines = ['{"client_id": 1, "interests": ["cars", "pets"]}', '', 'broken', '{"client_id": 3, "interests": [5]}',
+                 '{"client_id": 4, "interests": "cars"}', '{"client_id": "2", "interests": []}']
+        self.assertEqual(list(load_interests.read_jsonl(lines)), [(1, ["cars", "pets"]), (2, [])])
+
+        lines = ["1,cars,pets\n", "2\n", "x,cars\n", "3,\xd0\xba\xd0\xbd\xd0\xb8\xd0\xb3\xd0\xb8\n"]
+        self.assertEqual(list(load_interests.read_csv(lines)), [(1, ["cars", "pets"]), (2, []), (3, [u"книги"])])
+
+    def test_batches(self):
+        self.assertEqual(list(load_interests.batches(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+
+    def test_load(self):
+        db = store.MemoryStore()
+        records = ((cid, ["interest%s" % cid]) for cid in xrange(1000))
+        progress = load_interests.load(db, load_interests.encode(records), batch_size=64, workers=3)
+
+        self.assertEqual(progress.written, 1000)
+        self.assertEqual(progress.batches, 16)
+        self.assertEqual(scoring.get_interests(db, 999), ["interest999"])
+
+    def test_load_error(self):
+        db = store.MemoryStore()
+        def fail(items):
+            raise store.StoreError("fail")
+        db.set_many = fail
+        items = (("i:%s" % cid, "[]") for cid in xrange(1000))
+        with self.assertRaises(store.StoreError):
+            load_interests.load(db, items, batch_size=10, workers=2)
+
+
+class TestStorePool(unittest.TestCase):
+    def setUp(self):
+        self.pool = store.StoreTarantoolPool(min_size=1, max_size=2, checkout_timeout=0.1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_pool_write_read(self):
+        self.pool.set("test1", "test_val")
+        self.assertEqual(self.pool.get("test1"), "test_val")
+
+        self.pool.cache_set("test1", "test_val")
+        self.assertEqual(self.pool.cache_get("test1"), "test_val")
+
+    def test_pool_checkout_timeout(self):
+        with self.pool.connection():
+            with self.pool.connection():
+                self.assertEqual(self.pool.stats()["in_use"], 2)
+                with self.assertRaises(store.StoreError):
+                    self.pool.get("test1")
+
+        stats = self.pool.stats()
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["timeouts"], 1)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Timing spans for the request hot path and sampled request profiling.
+
+Spans opened inside `request_scope` are collected for that request (per
+thread) under its request_id. Every span duration also goes to a
+histogram - `span_seconds{span=...}` unless one is given.
+"""
+
+import cProfile
+import functools
+import logging
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+_local = threading.local()
+
+
+class Trace(object):
+
+    __slots__ = ('request_id', 'spans')
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.spans = []
+
+    def as_list(self):
+        """[(span name, milliseconds), ...] in order of completion"""
+        return [(name, round(seconds * 1000, 3)) for name, seconds in self.spans]
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def request_scope(request_id):
+    previous = current_trace()
+    _local.trace = trace = Trace(request_id)
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+
+@contextmanager
+def span(name, histogram=None):
+    started = time.time()
+    try:
+        yield
+    finally:
+        duration = time.time() - started
+        if histogram is None:
+            histogram = metrics.registry.histogram('span_seconds', 'Hot path span time', span=name)
+        histogram.observe(duration)
+
+        trace = current_trace()
+        if trace is not None:
+            trace.spans.append((name, duration))
+
+
+def traced(name, histogram=None):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, histogram):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Profiler(object):
+    """
+    Profiles `rate` share of requests with cProfile, aggregates the stats
+    and writes them (pstats format) to `dump_path` every `dump_interval`
+    seconds.
+    """
+
+    def __init__(self, rate=0, dump_path=None, dump_interval=60):
+        self.rate = rate
+        self._dump_path = dump_path
+        self._dump_interval = dump_interval
+        self._stats = None
+        self._profiled = 0
+        self._dumped_at = time.time()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def sample(self):
+        if not self.rate or random.random() >= self.rate:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._add(profile)
+
+    def _add(self, profile):
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self._profiled += 1
+
+            if self._dump_path and time.time() - self._dumped_at >= self._dump_interval:
+                self._dump()
+
+    def _dump(self):
+        try:
+            self._stats.dump_stats(self._dump_path)
+            logging.info('profile of %s requests written to %s', self._profiled, self._dump_path)
+        except (IOError, OSError) as e:
+            logging.error('profile dump error: %s', e)
+        self._dumped_at = time.time()
+
+    def dump(self):
+        with self._lock:
+            if self._stats is not None and self._dump_path:
+                self._dump()